@@ -0,0 +1,178 @@
+"""Фейковый сервер Bot API для нагрузочных тестов.
+
+    python -m bench.fake_bot_api [--port 8081] [--latency 0.05] [--blocked 0.05] [--rate-limit 30]
+
+Бот направляется на него через TELEGRAM_API_URL=http://127.0.0.1:8081.
+Отвечает на sendMessage, sendPhoto, copyMessage и прочие методы с заданной
+задержкой; доля ошибок 403/5xx и 429 с retry_after настраивается.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from aiohttp import web
+
+SEND_METHODS = {'sendmessage', 'sendphoto', 'copymessage', 'sendvideo', 'senddocument',
+                'sendanimation', 'sendvoice', 'sendmediagroup', 'copymessages'}
+
+
+class FakeBotAPI:
+    """Отвечает как Bot API; счетчики ответов по методам и кодам в self.responses.
+
+    rate_limit - сколько отправок в секунду принимается до ответа 429 (как flood
+    control у Telegram); flood - доля случайных 429 сверх этого.
+    Заблокированные и удаленные пользователи выбираются детерминированно по
+    chat_id, поэтому повторная рассылка получает те же ошибки.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, blocked: float = 0.0,
+                 deactivated: float = 0.0, server_errors: float = 0.0, flood: float = 0.0,
+                 rate_limit: float = None, retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.blocked = blocked
+        self.deactivated = deactivated
+        self.server_errors = server_errors
+        self.flood = flood
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._sent_at = deque()
+        self._message_id = 0
+        self.responses = Counter()
+
+    def _user_fate(self, chat_id: int) -> float:
+        return random.Random(f"{self.seed}:{chat_id}").random()
+
+    def _flood_limited(self) -> bool:
+        if self.rate_limit is None:
+            return False
+        now = time.monotonic()
+        while self._sent_at and now - self._sent_at[0] >= 1:
+            self._sent_at.popleft()
+        if len(self._sent_at) >= self.rate_limit:
+            return True
+        self._sent_at.append(now)
+        return False
+
+    def _error(self, method: str, code: int, description: str, **parameters) -> web.Response:
+        self.responses[(method, code)] += 1
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return web.json_response(body, status=code)
+
+    def _result(self, method: str, result) -> web.Response:
+        self.responses[(method, 200)] += 1
+        return web.json_response({'ok': True, 'result': result})
+
+    def _message(self, chat_id, **fields) -> dict:
+        self._message_id += 1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **fields
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        lowered = method.lower()
+        params = dict(await request.post())
+
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if lowered == 'getme':
+            return self._result(method, {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+        if lowered not in SEND_METHODS:
+            if lowered.startswith('edit'):
+                return self._result(method, self._message(int(params.get('chat_id', 0)), text=params.get('text')))
+            return self._result(method, True)
+
+        chat_id = int(params.get('chat_id', 0))
+        if self._flood_limited() or self._random.random() < self.flood:
+            return self._error(method, 429, f"Too Many Requests: retry after {self.retry_after}",
+                               retry_after=self.retry_after)
+        fate = self._user_fate(chat_id)
+        if fate < self.blocked:
+            return self._error(method, 403, "Forbidden: bot was blocked by the user")
+        if fate < self.blocked + self.deactivated:
+            return self._error(method, 403, "Forbidden: user is deactivated")
+        if self._random.random() < self.server_errors:
+            return self._error(method, 500, "Internal Server Error")
+
+        if lowered == 'copymessage':
+            return self._result(method, {'message_id': self._message(chat_id)['message_id']})
+        if lowered == 'copymessages':
+            return self._result(method, [{'message_id': self._message(chat_id)['message_id']}])
+        if lowered == 'sendphoto':
+            photo = {'file_id': 'bench', 'file_unique_id': 'bench', 'width': 1, 'height': 1}
+            return self._result(method, self._message(chat_id, photo=[photo], caption=params.get('caption')))
+        if lowered == 'sendmediagroup':
+            return self._result(method, [self._message(chat_id)])
+        return self._result(method, self._message(chat_id, text=params.get('text')))
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.build_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def summary(self) -> dict:
+        return {f"{method} {code}": count for (method, code), count in sorted(self.responses.items())}
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', type=float, default=0.05, help="Задержка ответа, секунды")
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--blocked', type=float, default=0.0, help="Доля заблокировавших бота")
+    parser.add_argument('--deactivated', type=float, default=0.0, help="Доля удаленных аккаунтов")
+    parser.add_argument('--server-errors', type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument('--flood', type=float, default=0.0, help="Доля случайных 429")
+    parser.add_argument('--rate-limit', type=float, default=None, help="Отправок в секунду до 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args) -> FakeBotAPI:
+    return FakeBotAPI(
+        latency=args.latency, jitter=args.jitter, blocked=args.blocked, deactivated=args.deactivated,
+        server_errors=args.server_errors, flood=args.flood, rate_limit=args.rate_limit,
+        retry_after=args.retry_after, seed=args.seed
+    )
+
+
+async def serve(api: FakeBotAPI, host: str, port: int):
+    runner = await api.start(host, port)
+    print(f"Фейковый Bot API: http://{host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(api.summary(), ensure_ascii=False, indent=2))
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый сервер Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(from_arguments(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""Нагрузочные сценарии против фейкового Bot API (bench/fake_bot_api.py).
+
+    python -m bench.run broadcast --users 100000 --rate 30 --workers 16 --blocked 0.05
+    python -m bench.run join_flood --requests 20000 --duplicates 0.1 --join-workers 4
+
+Нужна настроенная БД (DB_* в .env); пользователи дополняются через bench.seed.
+Фейковый сервер по умолчанию запускается в этом же процессе; --api-url
+направляет бота на внешний, чтобы он не делил с ботом процессор.
+Результат печатается, а с --output дописывается строкой JSON - так удобно
+сравнивать прогоны между релизами.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from dotenv import load_dotenv
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update, ChatJoinRequest, Chat, User, Message
+from bench import fake_bot_api
+
+BENCH_TOKEN = '123456:BENCH'
+# Заявки join_flood идут в несуществующий канал, а не в CHANNEL_ID бота
+BENCH_CHAT_ID = -1000000000001
+SEND_METHODS = {'SendMessage', 'SendPhoto', 'CopyMessage', 'SendVideo', 'SendDocument',
+                'SendAnimation', 'SendVoice', 'SendMediaGroup', 'CopyMessages'}
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def peak_rss_mb() -> float:
+    # На Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LatencyRecorder(BaseRequestMiddleware):
+    """Время и исход каждого вызова Bot API по методам"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes = Counter()
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            self.latencies[name].append(time.perf_counter() - started)
+            self.outcomes[(name, outcome)] += 1
+
+    def send_latencies(self):
+        return [value for name, values in self.latencies.items() if name in SEND_METHODS for value in values]
+
+    def count(self, outcome: str) -> int:
+        return sum(count for (_, name), count in self.outcomes.items() if name == outcome)
+
+
+class PoolProbe:
+    """Раз в interval секунд берет соединение из пула и замеряет ожидание.
+
+    Пробное соединение стоит в той же очереди, что и рабочие запросы, поэтому
+    его ожидание показывает, упирается ли сценарий в размер пула.
+    """
+
+    def __init__(self, pool, interval: float = 0.05):
+        self.pool = pool
+        self.interval = interval
+        self.waits = []
+        self.max_in_use = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.max_in_use = max(self.max_in_use, self.pool.get_size() - self.pool.get_idle_size())
+            started = time.perf_counter()
+            async with self.pool.acquire():
+                self.waits.append(time.perf_counter() - started)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def summary(self) -> dict:
+        return {
+            'pool_wait_p50_ms': percentile(self.waits, 50) * 1000,
+            'pool_wait_p99_ms': percentile(self.waits, 99) * 1000,
+            'pool_wait_max_ms': max(self.waits, default=0.0) * 1000,
+            'pool_max_in_use': self.max_in_use
+        }
+
+
+def make_bot(api_url: str) -> Bot:
+    return Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+
+
+def latency_summary(recorder: LatencyRecorder) -> dict:
+    latencies = recorder.send_latencies()
+    return {
+        'api_calls': sum(recorder.outcomes.values()),
+        'send_p50_ms': percentile(latencies, 50) * 1000,
+        'send_p99_ms': percentile(latencies, 99) * 1000,
+        'retry_after': recorder.count('TelegramRetryAfter')
+    }
+
+
+async def bench_broadcast(args, api_url: str) -> dict:
+    import database
+    import mailing_system
+    from bench.seed import BENCH_USER_ID_BASE, seed_users, reset_users
+
+    await database.init_db()
+    bot = make_bot(api_url)
+    recorder = LatencyRecorder()
+    bot.session.middleware(recorder)
+    try:
+        if args.users:
+            await seed_users(args.users)
+        await reset_users()
+        # Фейковый API принимает copyMessage из любого чата
+        payload = mailing_system.dump_mailing_payload({
+            'content_type': 'text', 'from_chat_id': args.from_chat_id, 'message_ids': [1]
+        })
+        # Только синтетические пользователи: ответы фейкового API пишутся в delivery_status
+        job = await database.create_broadcast_job(0, payload, {'min_user_id': BENCH_USER_ID_BASE})
+
+        probe = PoolProbe(database.pool)
+        probe.start()
+        started = time.perf_counter()
+        await mailing_system.run_broadcast_job(bot, job['id'], asyncio.Event())
+        elapsed = time.perf_counter() - started
+        probe.stop()
+
+        job = await database.get_broadcast_job(job['id'])
+        async with database.pool.acquire() as conn:
+            await conn.execute('DELETE FROM broadcast_recipients WHERE job_id = $1', job['id'])
+            await conn.execute('DELETE FROM broadcast_jobs WHERE id = $1', job['id'])
+    finally:
+        await bot.session.close()
+        await database.close_db()
+
+    return {
+        'recipients': job['total'],
+        'sent': job['sent'],
+        'failed': job['failed'],
+        'status': job['status'],
+        'elapsed_s': elapsed,
+        'msgs_per_sec': (job['sent'] + job['failed']) / elapsed if elapsed else 0.0,
+        **latency_summary(recorder),
+        **probe.summary()
+    }
+
+
+def build_join_updates(count: int, duplicates: float, chat_id: int):
+    from bench.seed import BENCH_USER_ID_BASE
+
+    chat = Chat(id=chat_id, type='channel', title='Bench')
+    unique = max(1, round(count * (1 - duplicates)))
+    updates = []
+    for update_id in range(count):
+        # Сначала уникальные заявки, затем повторы уже отправленных
+        user_id = BENCH_USER_ID_BASE + update_id % unique
+        user = User(id=user_id, is_bot=False, first_name='Bench', username=f'bench_{user_id}')
+        updates.append(Update(update_id=update_id, chat_join_request=ChatJoinRequest(
+            chat=chat, from_user=user, user_chat_id=user_id, date=datetime.now()
+        )))
+    return updates
+
+
+def build_verify_updates(user_ids, first_update_id: int):
+    """Нажатия "Я человек" от пользователей, подавших заявки"""
+    updates = []
+    for offset, user_id in enumerate(user_ids):
+        user = User(id=user_id, is_bot=False, first_name='Bench', username=f'bench_{user_id}')
+        updates.append(Update(update_id=first_update_id + offset, message=Message(
+            message_id=offset + 1, date=datetime.now(), chat=Chat(id=user_id, type='private'),
+            from_user=user, text="Я человек"
+        )))
+    return updates
+
+
+async def wait_for_approvals(database, timeout: float):
+    """Ждет, пока одобряющий закроет все проверенные заявки"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        counts = await database.count_open_join_requests()
+        if not counts.get('verified') and not counts.get('processing'):
+            return
+        await asyncio.sleep(0.2)
+
+
+async def bench_join_flood(args, api_url: str) -> dict:
+    # main создает бота и очередь при импорте, поэтому настройки - через окружение
+    os.environ['TELEGRAM_API_URL'] = api_url
+    os.environ.setdefault('TOKEN', BENCH_TOKEN)
+    os.environ['JOIN_WORKERS'] = str(args.join_workers)
+    os.environ['JOIN_APPROVE_RATE'] = str(args.approve_rate)
+    os.environ['JOIN_APPROVE_INTERVAL'] = '1'
+    import database
+    import main as bot_main
+
+    await database.init_db()
+    recorder = LatencyRecorder()
+    bot_main.bot.session.middleware(recorder)
+    updates = build_join_updates(args.requests, args.duplicates, BENCH_CHAT_ID)
+    user_ids = sorted({update.chat_join_request.from_user.id for update in updates})
+    verify_updates = build_verify_updates(user_ids[:round(len(user_ids) * args.verified)], len(updates))
+    async with database.pool.acquire() as conn:
+        existing = {row['user_id'] for row in await conn.fetch(
+            'SELECT user_id FROM users WHERE user_id = ANY($1::bigint[])', user_ids
+        )}
+    try:
+        probe = PoolProbe(database.pool)
+        probe.start()
+        bot_main.join_queue.start()
+        bot_main.join_approver.start()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def feed(update):
+            async with semaphore:
+                await bot_main.dp.feed_update(bot_main.bot, update)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(feed(update) for update in updates))
+        ingested = time.perf_counter() - started
+        await bot_main.join_queue.stop(timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+        # Проверка и фоновое одобрение заявок
+        approve_started = time.perf_counter()
+        await asyncio.gather(*(feed(update) for update in verify_updates))
+        await wait_for_approvals(database, args.timeout)
+        approve_elapsed = time.perf_counter() - approve_started
+        probe.stop()
+    finally:
+        await bot_main.join_approver.stop()
+        await bot_main.bot.session.close()
+        # Заявки и пользователи, созданные прогоном, не должны остаться в базе
+        await database.flush_pending_users()
+        async with database.pool.acquire() as conn:
+            await conn.execute('DELETE FROM pending_join_requests WHERE chat_id = $1', BENCH_CHAT_ID)
+            await conn.execute(
+                'DELETE FROM users WHERE user_id = ANY($1::bigint[])',
+                [user_id for user_id in user_ids if user_id not in existing]
+            )
+        await database.close_db()
+
+    queue = bot_main.join_queue.metrics()
+    approvals = {f'{action}_{status}': count for (action, status), count in bot_main.join_approver.results.items()}
+    approved = bot_main.join_approver.results[('approve', 'approved')]
+    return {
+        'requests': len(updates),
+        'deduplicated': queue['deduplicated'],
+        'processed': queue['processed'],
+        'failed': queue['failed'],
+        'left_in_queue': queue['depth'],
+        'ingest_s': ingested,
+        'elapsed_s': elapsed,
+        'ingest_per_sec': len(updates) / ingested if ingested else 0.0,
+        'processed_per_sec': queue['processed'] / elapsed if elapsed else 0.0,
+        'queue_wait_avg_ms': queue['avg_wait'] * 1000,
+        'queue_wait_max_ms': queue['max_wait'] * 1000,
+        'verified': len(verify_updates),
+        'approvals': approvals,
+        'approve_s': approve_elapsed,
+        'approved_per_sec': approved / approve_elapsed if approve_elapsed else 0.0,
+        **latency_summary(recorder),
+        **probe.summary()
+    }
+
+
+SCENARIOS = {
+    'broadcast': bench_broadcast,
+    'join_flood': bench_join_flood
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    api = None
+    runner = None
+    api_url = args.api_url
+    if not api_url:
+        api = fake_bot_api.from_arguments(args)
+        runner = await api.start('127.0.0.1', args.api_port)
+        api_url = f"http://127.0.0.1:{args.api_port}"
+    try:
+        result = await SCENARIOS[args.scenario](args, api_url)
+    finally:
+        if runner:
+            await runner.cleanup()
+    result['peak_rss_mb'] = peak_rss_mb()
+    if api:
+        result['fake_api_responses'] = api.summary()
+    return result
+
+
+def print_result(scenario: str, result: dict):
+    print(f"Сценарий: {scenario}")
+    for key, value in result.items():
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        elif isinstance(value, dict):
+            value = ", ".join(f"{name}: {count}" for name, count in value.items())
+        print(f"  {key}: {value}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Нагрузочные сценарии бота")
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--api-url', help="Внешний фейковый Bot API вместо встроенного")
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--output', help="Файл, куда дописать результат строкой JSON")
+    # broadcast
+    parser.add_argument('--users', type=int, default=0, help="Дополнить синтетических пользователей до N")
+    parser.add_argument('--rate', type=float, default=30, help="MAILING_RATE_LIMIT")
+    parser.add_argument('--workers', type=int, default=16, help="MAILING_WORKERS")
+    parser.add_argument('--from-chat-id', type=int, default=1, help="Чат черновика для copyMessage")
+    # join_flood
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--duplicates', type=float, default=0.0, help="Доля повторных заявок")
+    parser.add_argument('--join-workers', type=int, default=4, help="JOIN_WORKERS")
+    parser.add_argument('--verified', type=float, default=1.0, help="Доля подавших заявку, нажавших 'Я человек'")
+    parser.add_argument('--approve-rate', type=float, default=20, help="JOIN_APPROVE_RATE")
+    parser.add_argument('--concurrency', type=int, default=100, help="Одновременно подаваемых апдейтов")
+    parser.add_argument('--timeout', type=float, default=600, help="Сколько ждать разбора очереди")
+    fake_bot_api.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Модули бота читают настройки при импорте
+    os.environ['MAILING_RATE_LIMIT'] = str(args.rate)
+    os.environ['MAILING_WORKERS'] = str(args.workers)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from logging_setup import setup_logging, shutdown_logging
+
+    setup_logging()
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        shutdown_logging()
+
+    print_result(args.scenario, result)
+    if args.output:
+        record = {
+            'scenario': args.scenario,
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'args': vars(args),
+            **result
+        }
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Заполняет таблицу users синтетическими пользователями для нагрузочных тестов.
+
+    python -m bench.seed --users 100000
+
+Пользователи получают user_id начиная с BENCH_USER_ID_BASE, поэтому не
+пересекаются с настоящими; --clear удаляет только их.
+"""
+import argparse
+import asyncio
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import database
+
+BENCH_USER_ID_BASE = 10 ** 12
+
+# Даты регистрации растянуты на 90 дней назад, чтобы статистика и пагинация
+# работали на реалистичном распределении
+SEED_USERS_SQL = '''
+    INSERT INTO users (user_id, username, first_name, created_at)
+    SELECT $1 + g, 'bench_' || g, 'Bench',
+           CURRENT_TIMESTAMP - (g % 90) * INTERVAL '1 day'
+    FROM generate_series($2::bigint, $3::bigint) AS g
+    ON CONFLICT (user_id) DO NOTHING
+'''
+
+
+async def count_bench_users(conn) -> int:
+    return await conn.fetchval('SELECT COUNT(*) FROM users WHERE user_id >= $1', BENCH_USER_ID_BASE)
+
+
+async def seed_users(target: int, batch_size: int = 50000) -> int:
+    """Дополняет синтетических пользователей до target; возвращает, сколько добавлено"""
+    async with database.pool.acquire() as conn:
+        existing = await count_bench_users(conn)
+        for start in range(existing, target, batch_size):
+            end = min(start + batch_size, target) - 1
+            await conn.execute(SEED_USERS_SQL, BENCH_USER_ID_BASE, start, end)
+        await conn.execute('ANALYZE users')
+    return max(target - existing, 0)
+
+
+async def reset_users():
+    """Возвращает синтетическим пользователям статус active после прошлых прогонов"""
+    async with database.pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE users SET delivery_status = 'active', last_failure_at = NULL "
+            "WHERE user_id >= $1 AND delivery_status <> 'active'",
+            BENCH_USER_ID_BASE
+        )
+
+
+async def clear_users():
+    async with database.pool.acquire() as conn:
+        await conn.execute('DELETE FROM users WHERE user_id >= $1', BENCH_USER_ID_BASE)
+
+
+async def run(args):
+    await database.init_db()
+    try:
+        if args.clear:
+            await clear_users()
+            print("Синтетические пользователи удалены")
+            return
+        started = time.monotonic()
+        added = await seed_users(args.users, args.batch)
+        print(f"Добавлено пользователей: {added} за {time.monotonic() - started:.2f}с (цель {args.users})")
+    finally:
+        await database.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические пользователи для бенчмарков")
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=50000)
+    parser.add_argument('--clear', action='store_true')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
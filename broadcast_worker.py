@@ -0,0 +1,239 @@
+"""Процессы доставки рассылок.
+
+    python broadcast_worker.py [--processes 4]
+
+Нужен боту с MAILING_EXECUTOR=workers: бот создает задания и показывает
+прогресс, а отправляют сообщения эти процессы. Каждый процесс забирает
+получателей пачками (FOR UPDATE SKIP LOCKED, без пересечений с соседями)
+и берет токены из общего бакета send_budget в БД, поэтому суммарная
+скорость не превышает MAILING_RATE_LIMIT при любом числе процессов.
+Пачки процесса, упавшего посреди рассылки, забираются заново через
+BROADCAST_CLAIM_LEASE секунд.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from dotenv import load_dotenv
+
+# Модули ниже читают настройки из окружения при импорте
+load_dotenv()
+
+import database
+import mailing_system
+from logging_setup import setup_logging, shutdown_logging
+from metrics import instrument_bot
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TOKEN = os.getenv('TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+BROADCAST_WORKER_PROCESSES = int(os.getenv('BROADCAST_WORKER_PROCESSES', os.cpu_count() or 1))
+# Сколько получателей процесс забирает за раз
+BROADCAST_CLAIM_BATCH = int(os.getenv('BROADCAST_CLAIM_BATCH', 500))
+# Через сколько секунд пачку, не отмеченную результатами, может забрать другой процесс
+BROADCAST_CLAIM_LEASE = float(os.getenv('BROADCAST_CLAIM_LEASE', 300))
+# Пауза между проверками, когда рассылать нечего, секунды
+BROADCAST_IDLE_INTERVAL = float(os.getenv('BROADCAST_IDLE_INTERVAL', 2))
+# Сколько токенов процесс берет из общего бакета одним запросом (не больше)
+SEND_BUDGET_CHUNK = int(os.getenv('SEND_BUDGET_CHUNK', 5))
+# Сколько секунд процесс может тратить полученные токены. Пауза по 429 из другого
+# процесса видна только в БД, поэтому неистраченные токены сгорают, а за паузу
+# все процессы вместе успевают потратить не больше rate * TTL токенов
+SEND_BUDGET_TOKEN_TTL = float(os.getenv('SEND_BUDGET_TOKEN_TTL', 0.5))
+
+
+class SharedSendBudget:
+    """Лимит отправок, общий для всех процессов: токены выдаются из строки send_budget.
+
+    Совместим с TokenBucket в run_broadcast (acquire/pause). Токены берутся
+    пачками, чтобы не ходить в БД за каждым сообщением: на процесс не больше
+    его доли rate за token_ttl, и живут они token_ttl секунд.
+    """
+
+    def __init__(self, rate: float = mailing_system.MAILING_RATE_LIMIT, processes: int = 1,
+                 chunk: int = SEND_BUDGET_CHUNK, token_ttl: float = SEND_BUDGET_TOKEN_TTL):
+        self.rate = rate
+        self.chunk = max(1, min(chunk, int(rate / processes * token_ttl)))
+        self.token_ttl = token_ttl
+        self._tokens = 0
+        self._tokens_expire = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._pending = set()
+
+    async def acquire(self):
+        async with self._lock:
+            if time.monotonic() >= self._tokens_expire:
+                self._tokens = 0
+            while self._tokens < 1:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                granted, wait = await database.take_send_budget(self.rate, self.rate, self.chunk)
+                self._tokens = granted
+                self._tokens_expire = time.monotonic() + self.token_ttl
+                if not granted:
+                    await asyncio.sleep(max(wait, 0.01))
+            self._tokens -= 1
+
+    def pause(self, seconds: float):
+        """429 относится ко всему боту: останавливаем и свой процесс, и общий бакет"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        task = asyncio.create_task(database.pause_send_budget(seconds))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+
+def make_bot() -> Bot:
+    bot = Bot(
+        token=TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    )
+    instrument_bot(bot)
+    return bot
+
+
+async def claim_batch(worker: str):
+    """Первая пачка получателей из запущенных заданий: (задание, список user_id) или None"""
+    for job in await database.get_running_broadcast_jobs():
+        user_ids = await database.claim_broadcast_recipients(
+            job['id'], BROADCAST_CLAIM_BATCH, worker, BROADCAST_CLAIM_LEASE
+        )
+        if user_ids:
+            return job, user_ids
+    return None
+
+
+async def _single_page(user_ids):
+    yield user_ids
+
+
+async def update_pace(pacer: TokenBucket, job_id: int):
+    state = await database.get_job_delivery_state(job_id)
+    pace = mailing_system.delivery_pace(state['remaining'], state['window_end'])
+    # Без ограничения окна (оно закончилось или лимит медленнее) темп упирается в общий бакет
+    pacer.set_rate(pace / max(state['workers'], 1) if pace else mailing_system.MAILING_RATE_LIMIT)
+
+
+async def refresh_pace(pacer: TokenBucket, job_id: int):
+    while True:
+        await asyncio.sleep(mailing_system.DELIVERY_PACE_REFRESH)
+        try:
+            await update_pace(pacer, job_id)
+        except Exception as e:
+            logger.warning("Не удалось пересчитать темп доставки: %s", e,
+                           extra={'job_id': job_id, 'error_class': type(e).__name__})
+
+
+async def deliver_batch(bot: Bot, worker: str, job, user_ids, budget: SharedSendBudget,
+                        stop: asyncio.Event):
+    job_id = job['id']
+    data = mailing_system.load_mailing_payload(job['payload'])
+    job_stop = asyncio.Event()
+    checkpoint = mailing_system.JobCheckpoint(job_id, job_stop)
+    pacer = None
+    pacer_refresh = None
+    if job['window_end']:
+        # Темп окна доставки делят процессы, которые сейчас рассылают это задание
+        pacer = TokenBucket(mailing_system.MAILING_RATE_LIMIT, capacity=1)
+        await update_pace(pacer, job_id)
+        pacer_refresh = asyncio.create_task(refresh_pace(pacer, job_id))
+    stop_waiter = asyncio.create_task(stop.wait())
+    stop_waiter.add_done_callback(lambda _: job_stop.set())
+    logger.info("Пачка получателей: %d", len(user_ids), extra={'job_id': job_id})
+    try:
+        await mailing_system.run_broadcast(
+            bot, data, mailing_system.build_reply_markup(data.get('buttons')),
+            _single_page(user_ids), len(user_ids), limiter=budget,
+            on_result=checkpoint.record, stop_event=job_stop, job_id=job_id, pacer=pacer
+        )
+        await checkpoint.flush()
+    finally:
+        stop_waiter.cancel()
+        if pacer_refresh:
+            pacer_refresh.cancel()
+        # Необработанные (пауза, отмена, остановка процесса) возвращаются в очередь
+        released = await database.release_broadcast_recipients(job_id, worker)
+        if released:
+            logger.info("Возвращено в очередь: %d", released, extra={'job_id': job_id})
+
+
+async def work(processes: int):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await database.init_db()
+    bot = make_bot()
+    budget = SharedSendBudget(processes=processes)
+    logger.info("Процесс рассылки %s запущен", worker)
+    try:
+        while not stop.is_set():
+            try:
+                claimed = await claim_batch(worker)
+                if claimed:
+                    await deliver_batch(bot, worker, *claimed, budget, stop)
+                    continue
+            except Exception as e:
+                logger.exception("Ошибка обработки пачки", extra={'error_class': type(e).__name__})
+            try:
+                await asyncio.wait_for(stop.wait(), BROADCAST_IDLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        await bot.session.close()
+        await database.close_db()
+        logger.info("Процесс рассылки %s остановлен", worker)
+
+
+def run_process(processes: int):
+    setup_logging()
+    try:
+        asyncio.run(work(processes))
+    finally:
+        shutdown_logging()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Процессы доставки рассылок")
+    parser.add_argument('--processes', type=int, default=BROADCAST_WORKER_PROCESSES)
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_process(1)
+        return
+
+    children = [
+        multiprocessing.Process(target=run_process, args=(args.processes,), name=f"broadcast-worker-{index}")
+        for index in range(args.processes)
+    ]
+    for child in children:
+        child.start()
+
+    def forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for child in children:
+        child.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
+import asyncio
 import asyncpg
+import json
+import logging
 import os
-from typing import Optional
-from datetime import datetime
+import time
+from collections import OrderedDict
+from datetime import datetime, date
+import metrics
+
+logger = logging.getLogger(__name__)
 
 pool = None
 
@@ -11,26 +18,271 @@ DB_NAME = os.getenv('DB_NAME')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = int(os.getenv('DB_PORT', 5432))
 
+# Пул: размер, пересоздание соединений после DB_POOL_MAX_QUERIES запросов
+# и закрытие простаивающих дольше DB_POOL_MAX_INACTIVE_LIFETIME секунд
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_POOL_MAX_QUERIES = int(os.getenv('DB_POOL_MAX_QUERIES', 50000))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', 300))
+# Таймаут одного запроса, секунды
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', 30))
+# asyncpg готовит каждый запрос один раз на соединение и держит его в кэше по тексту SQL.
+# По умолчанию подготовленный запрос вытесняется после 300с простоя; 0 - держать,
+# пока живо соединение, чтобы горячие запросы (upsert, страницы получателей,
+# счетчики) не разбирались заново
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+DB_STATEMENT_CACHE_LIFETIME = float(os.getenv('DB_STATEMENT_CACHE_LIFETIME', 0))
+# Попытки подключения при старте: пауза удваивается от DB_CONNECT_BACKOFF до DB_CONNECT_BACKOFF_MAX
+DB_CONNECT_RETRIES = int(os.getenv('DB_CONNECT_RETRIES', 5))
+DB_CONNECT_BACKOFF = float(os.getenv('DB_CONNECT_BACKOFF', 1))
+DB_CONNECT_BACKOFF_MAX = float(os.getenv('DB_CONNECT_BACKOFF_MAX', 30))
+# Ожидание соединения дольше этого (секунды) считается признаком нехватки пула
+DB_POOL_SLOW_ACQUIRE = float(os.getenv('DB_POOL_SLOW_ACQUIRE', 0.1))
+
+# Write-behind: профили копятся в памяти и сохраняются одним запросом
+DB_WRITE_BEHIND = os.getenv('DB_WRITE_BEHIND', '0') == '1'
+DB_WRITE_BEHIND_INTERVAL = float(os.getenv('DB_WRITE_BEHIND_INTERVAL', 0.5))
+DB_WRITE_BEHIND_MAX_BATCH = int(os.getenv('DB_WRITE_BEHIND_MAX_BATCH', 1000))
+
+# Кэш последних сохраненных профилей: повторное сохранение того же профиля
+# не идет в БД. TTL ограничивает расхождение с изменениями из других процессов
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 100000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 600))
+
+USER_SOURCES = ('start', 'join_request')
+
+# Канал NOTIFY о новых пользователях, payload "<дата>:<количество>"
+USERS_CREATED_CHANNEL = 'users_created'
+
+# delivery_status: active - доставка возможна; blocked / deactivated / unreachable -
+# постоянные ошибки доставки, такие пользователи исключаются из рассылок.
+# source - откуда пользователь пришел впервые: USER_SOURCES или NULL для старых записей
+# Строка переписывается, только если что-то действительно меняется: иначе UPDATE
+# оставляет мертвую версию строки и запись в WAL ради одного updated_at
+USER_CHANGED_CONDITION = '''
+    users.username IS DISTINCT FROM EXCLUDED.username
+        OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+        OR users.last_name IS DISTINCT FROM EXCLUDED.last_name
+        OR ($5::bool AND users.delivery_status IS DISTINCT FROM 'active')
+        OR (users.source IS NULL AND EXCLUDED.source IS NOT NULL)
+'''
+
+UPSERT_USER_SQL = '''
+    INSERT INTO users (user_id, username, first_name, last_name, source)
+    VALUES ($1, $2, $3, $4, $6)
+    ON CONFLICT (user_id) DO UPDATE
+    SET username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        delivery_status = CASE WHEN $5::bool THEN 'active' ELSE users.delivery_status END,
+        source = COALESCE(users.source, EXCLUDED.source),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE {changed}
+    RETURNING *, (xmax = 0) AS inserted
+'''.format(changed=USER_CHANGED_CONDITION)
+
+UPSERT_USERS_BATCH_SQL = '''
+    WITH upserted AS (
+        INSERT INTO users (user_id, username, first_name, last_name, source)
+        SELECT * FROM unnest($1::bigint[], $2::varchar[], $3::varchar[], $4::varchar[], $6::varchar[])
+        ON CONFLICT (user_id) DO UPDATE
+        SET username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            delivery_status = CASE WHEN $5::bool THEN 'active' ELSE users.delivery_status END,
+            source = COALESCE(users.source, EXCLUDED.source),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE {changed}
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT COUNT(*) FILTER (WHERE inserted) FROM upserted
+'''.format(changed=USER_CHANGED_CONDITION)
+
+# Дата в ISO независимо от DateStyle сервера
+NOTIFY_USERS_CREATED_SQL = (
+    f"SELECT pg_notify('{USERS_CREATED_CHANNEL}', to_char(CURRENT_DATE, 'YYYY-MM-DD') || ':' || $1::int)"
+)
+
+USER_COUNTERS_SQL = '''
+    SELECT
+        COUNT(*) AS total_users,
+        COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS today_users,
+        COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE - 6) AS week_users,
+        COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE - 29) AS month_users,
+        COUNT(*) FILTER (WHERE delivery_status = 'active') AS reachable_users,
+        COUNT(*) FILTER (WHERE delivery_status = 'blocked') AS blocked_users,
+        COUNT(*) FILTER (WHERE delivery_status = 'deactivated') AS deactivated_users,
+        COUNT(*) FILTER (WHERE delivery_status = 'unreachable') AS unreachable_users
+    FROM users
+'''
+
+RECIPIENTS_PAGE_SQL = '''
+    SELECT user_id FROM broadcast_recipients
+    WHERE job_id = $1 AND status = 'pending' AND ($2::bigint IS NULL OR user_id > $2)
+    ORDER BY user_id LIMIT $3
+'''
+
+AUDIENCE_PAGE_SIZE = int(os.getenv('AUDIENCE_PAGE_SIZE', 1000))
+
+# Строка, по которой ищутся пользователи; то же выражение стоит в trigram-индексе
+USER_SEARCH_EXPR = "lower(coalesce(username, '') || ' ' || coalesce(first_name, '') || ' ' || coalesce(last_name, ''))"
+
+# Доступно ли расширение pg_trgm; без него поиск работает только по префиксу
+search_trgm_available = False
+
+_pending_users = {}
+_flush_event = None
+_flush_stop = None
+_flush_task = None
+
+# user_id -> (время сохранения, хэш профиля, известно ли, что пользователь active)
+_profile_cache = OrderedDict()
+metrics.USER_CACHE_SIZE.set_function(lambda: len(_profile_cache))
+
+
+class _MeteredAcquire:
+    def __init__(self, pool, context):
+        self._pool = pool
+        self._context = context
+
+    async def _acquire(self, acquire):
+        started = time.perf_counter()
+        self._pool.waiting += 1
+        try:
+            conn = await acquire
+        except asyncio.TimeoutError:
+            self._pool.timeouts += 1
+            raise
+        finally:
+            self._pool.waiting -= 1
+        self._pool.record_wait(time.perf_counter() - started)
+        return conn
+
+    def __await__(self):
+        return self._acquire(self._context).__await__()
+
+    async def __aenter__(self):
+        return await self._acquire(self._context.__aenter__())
+
+    async def __aexit__(self, *exc_info):
+        return await self._context.__aexit__(*exc_info)
+
+
+class MeteredPool:
+    """Пул asyncpg, замеряющий ожидание соединения в acquire().
+
+    Счетчики насыщения: сколько запросов ждут соединение сейчас, сколько
+    ждали дольше DB_POOL_SLOW_ACQUIRE, максимум ожидания и таймауты.
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self.waiting = 0
+        self.acquired = 0
+        self.slow_acquires = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, *, timeout=None):
+        return _MeteredAcquire(self, self._pool.acquire(timeout=timeout))
+
+    def record_wait(self, wait: float):
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if wait >= DB_POOL_SLOW_ACQUIRE:
+            self.slow_acquires += 1
+        metrics.DB_POOL_ACQUIRE_SECONDS.observe(wait)
+
+    def connection_counts(self) -> dict:
+        size = self._pool.get_size()
+        idle = self._pool.get_idle_size()
+        return {
+            ('in_use',): size - idle,
+            ('idle',): idle,
+            ('max',): self._pool.get_max_size(),
+            ('waiting',): self.waiting
+        }
+
+    def stats(self) -> dict:
+        size = self._pool.get_size()
+        in_use = size - self._pool.get_idle_size()
+        return {
+            'size': size,
+            'max_size': self._pool.get_max_size(),
+            'in_use': in_use,
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'slow_acquires': self.slow_acquires,
+            'timeouts': self.timeouts,
+            'avg_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+            'max_wait': self.max_wait
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+async def _create_pool() -> asyncpg.Pool:
+    for attempt in range(1, DB_CONNECT_RETRIES + 1):
+        try:
+            return await asyncpg.create_pool(
+                user=DB_USER,
+                password=DB_PASSWORD,
+                database=DB_NAME,
+                host=DB_HOST,
+                port=DB_PORT,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                max_queries=DB_POOL_MAX_QUERIES,
+                max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                max_cached_statement_lifetime=DB_STATEMENT_CACHE_LIFETIME,
+                init=_init_connection
+            )
+        except (OSError, asyncio.TimeoutError, asyncpg.CannotConnectNowError,
+                asyncpg.TooManyConnectionsError) as e:
+            # Ошибки авторизации и конфигурации повторять бесполезно, они не ловятся
+            if attempt == DB_CONNECT_RETRIES:
+                raise
+            delay = min(DB_CONNECT_BACKOFF * 2 ** (attempt - 1), DB_CONNECT_BACKOFF_MAX)
+            logger.warning("База данных недоступна (%s), повтор через %.1fс (%d/%d)",
+                           e, delay, attempt, DB_CONNECT_RETRIES, extra={'error_class': type(e).__name__})
+            await asyncio.sleep(delay)
+
 
 async def init_db():
     global pool
     try:
-        pool = await asyncpg.create_pool(
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            host=DB_HOST,
-            port=DB_PORT,
-            min_size=1,
-            max_size=10
-        )
-        print("[LOG] Подключение к базе данных установлено")
+        pool = MeteredPool(await _create_pool())
+        metrics.DB_POOL_CONNECTIONS.set_function(lambda: pool.connection_counts() if pool else {})
+        metrics.DB_POOL_SLOW_ACQUIRES.set_function(lambda: pool.slow_acquires if pool else 0)
+        logger.info("Подключение к базе данных установлено")
         await create_tables()
+        if DB_WRITE_BEHIND:
+            start_write_behind()
     except Exception as e:
-        print(f"[ERROR] Ошибка подключения к базе данных: {e}")
+        logger.exception("Ошибка подключения к базе данных", extra={'error_class': type(e).__name__})
         raise
 
 
+def _json_default(value):
+    # Модели aiogram (pydantic) в JSONB пишутся как словари
+    if hasattr(value, 'model_dump'):
+        return value.model_dump(mode='json', exclude_none=True)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_dumps(value) -> str:
+    return json.dumps(value, default=_json_default, ensure_ascii=False)
+
+
+async def _init_connection(conn):
+    await conn.set_type_codec('jsonb', encoder=_json_dumps, decoder=json.loads, schema='pg_catalog')
+
+
 async def create_tables():
     async with pool.acquire() as conn:
         await conn.execute('''
@@ -44,31 +296,367 @@ async def create_tables():
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        print("[LOG] Таблицы созданы/проверены")
+        await conn.execute('''
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(16) NOT NULL DEFAULT 'active',
+                ADD COLUMN IF NOT EXISTS last_failure_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS source VARCHAR(16)
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS users_reachable_idx
+            ON users (id) INCLUDE (user_id) WHERE delivery_status = 'active'
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS users_created_at_id_idx ON users (created_at, id)
+        ''')
+        await create_search_indexes(conn)
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state VARCHAR(255),
+                data JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS fsm_states_updated_at_idx ON fsm_states (updated_at)
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id SERIAL PRIMARY KEY,
+                admin_id BIGINT NOT NULL,
+                payload JSONB NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'running',
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                status_chat_id BIGINT,
+                status_message_id BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (job_id, user_id)
+            )
+        ''')
+        # Отложенный старт (status = 'scheduled') и окно доставки: отправки
+        # распределяются равномерно до window_end
+        await conn.execute('''
+            ALTER TABLE broadcast_jobs
+                ADD COLUMN IF NOT EXISTS start_at TIMESTAMPTZ,
+                ADD COLUMN IF NOT EXISTS window_end TIMESTAMPTZ
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS broadcast_jobs_scheduled_idx
+            ON broadcast_jobs (start_at) WHERE status = 'scheduled'
+        ''')
+        # Процессы broadcast_worker.py забирают получателей пачками: status = 'claimed'
+        # до записи результата; зависшие дольше аренды пачки забираются заново
+        await conn.execute('''
+            ALTER TABLE broadcast_recipients
+                ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64),
+                ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS broadcast_recipients_claimed_idx
+            ON broadcast_recipients (job_id, claimed_at) WHERE status = 'claimed'
+        ''')
+        # Число попыток доставки и сколько получателей задания доставлено не с первой
+        await conn.execute('''
+            ALTER TABLE broadcast_recipients ADD COLUMN IF NOT EXISTS attempts SMALLINT
+        ''')
+        await conn.execute('''
+            ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS retried INTEGER NOT NULL DEFAULT 0
+        ''')
+        # Общий для всех процессов токен-бакет отправок (одна строка id = 1).
+        # updated_at в будущем означает паузу по retry_after
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS send_budget (
+                id INTEGER PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL DEFAULT 0,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+                rate DOUBLE PRECISION,
+                rate_updated_at TIMESTAMPTZ
+            )
+        ''')
+        await conn.execute('INSERT INTO send_budget (id) VALUES (1) ON CONFLICT DO NOTHING')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS broadcast_recipients_pending_idx
+            ON broadcast_recipients (job_id, user_id) WHERE status = 'pending'
+        ''')
+        # Заявки на вступление до одобрения: pending - ждет проверки "Я человек",
+        # verified - проверку прошел, processing - забрана одобряющим,
+        # approved / declined / gone (заявку отозвали) / failed - итог
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS pending_join_requests (
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                verified_at TIMESTAMPTZ,
+                claimed_at TIMESTAMPTZ,
+                processed_at TIMESTAMPTZ,
+                error TEXT,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+        # attempts / retry_at - повторы после временных ошибок API (сеть, 5xx, нет прав админа)
+        await conn.execute('''
+            ALTER TABLE pending_join_requests
+                ADD COLUMN IF NOT EXISTS attempts SMALLINT NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS retry_at TIMESTAMPTZ
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS pending_join_requests_open_idx
+            ON pending_join_requests (requested_at) WHERE status IN ('pending', 'verified', 'processing')
+        ''')
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS pending_join_requests_user_idx
+            ON pending_join_requests (user_id) WHERE status = 'pending'
+        ''')
+        logger.info("Таблицы созданы/проверены")
+
 
+async def create_search_indexes(conn):
+    global search_trgm_available
+    try:
+        await conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        await conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS users_search_trgm_idx
+            ON users USING gin (({USER_SEARCH_EXPR}) gin_trgm_ops)
+        ''')
+        search_trgm_available = True
+    except asyncpg.PostgresError as e:
+        logger.warning("pg_trgm недоступен, поиск только по началу строки: %s", e)
+        search_trgm_available = False
+        for column in ('username', 'first_name', 'last_name'):
+            await conn.execute(f'''
+                CREATE INDEX IF NOT EXISTS users_{column}_lower_idx
+                ON users (lower({column}) text_pattern_ops)
+            ''')
 
-async def get_or_create_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+
+async def get_or_create_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                             reactivate: bool = False, source: str = None):
+    """Upsert профиля одним запросом; None, если профиль не изменился (строка не перечитывается)"""
     async with pool.acquire() as conn:
-        user = await conn.fetchrow(
-            'SELECT * FROM users WHERE user_id = $1',
-            user_id
-        )
-        if not user:
-            user = await conn.fetchrow('''
-                INSERT INTO users (user_id, username, first_name, last_name)
-                VALUES ($1, $2, $3, $4)
-                RETURNING *
-            ''', user_id, username, first_name, last_name)
-            print(f"[LOG] Создан новый пользователь {user_id}")
-        else:
-            user = await conn.fetchrow('''
-                UPDATE users 
-                SET username = $2, first_name = $3, last_name = $4, updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = $1
-                RETURNING *
-            ''', user_id, username, first_name, last_name)
-            print(f"[LOG] Обновлен пользователь {user_id}")
-        return user
+        user = await conn.fetchrow(UPSERT_USER_SQL, user_id, username, first_name, last_name, reactivate, source)
+        if user is None:
+            # Профиль не изменился, UPDATE пропущен
+            logger.debug("Профиль не изменился", extra={'user_id': user_id})
+            return None
+        if user['inserted']:
+            await conn.execute(NOTIFY_USERS_CREATED_SQL, 1)
+    if user['inserted']:
+        logger.debug("Создан новый пользователь", extra={'user_id': user_id})
+    else:
+        logger.debug("Обновлен пользователь", extra={'user_id': user_id})
+    return user
+
+
+def _profile_unchanged(user_id: int, profile_hash: int, reactivate: bool) -> bool:
+    """Сохранялся ли недавно такой же профиль (reactivate - только если пользователь уже active)"""
+    cached = _profile_cache.get(user_id)
+    if (cached and time.monotonic() - cached[0] < USER_CACHE_TTL
+            and cached[1] == profile_hash and (cached[2] or not reactivate)):
+        _profile_cache.move_to_end(user_id)
+        metrics.USER_CACHE_LOOKUPS.inc('hit')
+        return True
+    metrics.USER_CACHE_LOOKUPS.inc('miss')
+    return False
+
+
+def _remember_profile(user_id: int, profile_hash: int, active: bool):
+    cached = _profile_cache.get(user_id)
+    active = active or bool(cached and cached[1] == profile_hash and cached[2])
+    _profile_cache[user_id] = (time.monotonic(), profile_hash, active)
+    _profile_cache.move_to_end(user_id)
+    while len(_profile_cache) > USER_CACHE_SIZE:
+        _profile_cache.popitem(last=False)
+
+
+def forget_profiles(user_ids):
+    """Убирает пользователей из кэша профилей (их строка изменилась в обход save_user)"""
+    for user_id in user_ids:
+        _profile_cache.pop(user_id, None)
+
+
+def start_write_behind():
+    global _flush_event, _flush_stop, _flush_task
+    if _flush_task:
+        return
+    _flush_event = asyncio.Event()
+    _flush_stop = asyncio.Event()
+    _flush_task = asyncio.create_task(_write_behind_loop())
+    logger.info("Write-behind включен (интервал %sс, пакет до %d)", DB_WRITE_BEHIND_INTERVAL, DB_WRITE_BEHIND_MAX_BATCH)
+
+
+async def _write_behind_loop():
+    while not _flush_stop.is_set():
+        try:
+            await asyncio.wait_for(_flush_event.wait(), timeout=DB_WRITE_BEHIND_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_event.clear()
+        await flush_pending_users()
+
+
+def queue_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+               reactivate: bool = False, source: str = None):
+    """Ставит профиль в очередь write-behind; повторы одного user_id схлопываются"""
+    previous = _pending_users.get(user_id)
+    _pending_users[user_id] = (
+        username, first_name, last_name,
+        reactivate or bool(previous and previous[3]),
+        previous[4] if previous and previous[4] else source
+    )
+    if len(_pending_users) >= DB_WRITE_BEHIND_MAX_BATCH and _flush_event:
+        _flush_event.set()
+
+
+def _requeue_users(batch: dict):
+    """Возвращает несохраненный пакет в очередь; более свежие профили из очереди не трогает"""
+    for uid, profile in batch.items():
+        _pending_users.setdefault(uid, profile)
+
+
+async def flush_pending_users() -> int:
+    global _pending_users
+    if not _pending_users:
+        return 0
+    batch = _pending_users
+    _pending_users = {}
+    # Сортировка по user_id дает одинаковый порядок блокировок строк
+    user_ids = sorted(batch)
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                created = 0
+                for reactivate in (False, True):
+                    group = [uid for uid in user_ids if batch[uid][3] == reactivate]
+                    if not group:
+                        continue
+                    created += await conn.fetchval(
+                        UPSERT_USERS_BATCH_SQL,
+                        group,
+                        [batch[uid][0] for uid in group],
+                        [batch[uid][1] for uid in group],
+                        [batch[uid][2] for uid in group],
+                        reactivate,
+                        [batch[uid][4] for uid in group]
+                    )
+                if created:
+                    await conn.execute(NOTIFY_USERS_CREATED_SQL, created)
+    except Exception as e:
+        logger.error("Ошибка пакетного сохранения %d пользователей: %s", len(batch), e,
+                     extra={'error_class': type(e).__name__})
+        _requeue_users(batch)
+        return 0
+    except BaseException:
+        # Отмена посреди записи: транзакция откатилась, пакет не должен пропасть
+        _requeue_users(batch)
+        raise
+    logger.debug("Пакетно сохранено пользователей: %d", len(batch))
+    return len(batch)
+
+
+async def add_join_request(chat_id: int, user_id: int, requested_at: datetime = None):
+    """Записывает заявку на вступление; повторная заявка снова ждет проверки"""
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO pending_join_requests (chat_id, user_id, requested_at)
+            VALUES ($1, $2, COALESCE($3, now()))
+            ON CONFLICT (chat_id, user_id) DO UPDATE
+            SET status = 'pending', requested_at = EXCLUDED.requested_at,
+                verified_at = NULL, claimed_at = NULL, processed_at = NULL, error = NULL,
+                attempts = 0, retry_at = NULL
+            WHERE pending_join_requests.status NOT IN ('pending', 'verified', 'processing')
+        ''', chat_id, user_id, requested_at)
+
+
+async def verify_join_requests(user_id: int) -> int:
+    """Отмечает заявки пользователя как прошедшие проверку; возвращает их число"""
+    async with pool.acquire() as conn:
+        result = await conn.execute('''
+            UPDATE pending_join_requests
+            SET status = 'verified', verified_at = now(), attempts = 0, retry_at = NULL
+            WHERE user_id = $1 AND status = 'pending'
+        ''', user_id)
+    return int(result.split()[-1])
+
+
+async def claim_join_requests(limit: int, expire_after: float, lease: float):
+    """Забирает заявки к обработке: проверенные - одобрить, непроверенные дольше
+    expire_after секунд - отклонить (0 - не отклонять). Заявки, забранные дольше
+    lease секунд назад и не закрытые, забираются заново.
+
+    Заявки, отложенные после временной ошибки, ждут retry_at.
+    Возвращает строки (chat_id, user_id, action, attempts), action - 'approve' или 'decline'.
+    """
+    async with pool.acquire() as conn:
+        return await conn.fetch('''
+            WITH due AS (
+                SELECT chat_id, user_id,
+                       CASE WHEN verified_at IS NOT NULL THEN 'approve' ELSE 'decline' END AS action
+                FROM pending_join_requests
+                WHERE (status = 'verified' AND (retry_at IS NULL OR retry_at <= now()))
+                   OR (status = 'pending' AND $2::float8 > 0
+                       AND requested_at < now() - make_interval(secs => $2)
+                       AND (retry_at IS NULL OR retry_at <= now()))
+                   OR (status = 'processing' AND claimed_at < now() - make_interval(secs => $3))
+                ORDER BY requested_at
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE pending_join_requests p
+            SET status = 'processing', claimed_at = now()
+            FROM due
+            WHERE p.chat_id = due.chat_id AND p.user_id = due.user_id
+            RETURNING p.chat_id, p.user_id, due.action, p.attempts
+        ''', limit, expire_after, lease)
+
+
+async def finish_join_requests(results):
+    """Сохраняет итоги: список (chat_id, user_id, status, error, retry_in).
+
+    Если retry_in не None, заявка возвращается в прежний статус (verified или
+    pending) и снова забирается не раньше чем через retry_in секунд.
+    """
+    if not results:
+        return
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            UPDATE pending_join_requests p
+            SET status = CASE WHEN r.retry_in IS NULL THEN r.status
+                              WHEN p.verified_at IS NOT NULL THEN 'verified'
+                              ELSE 'pending' END,
+                error = r.error,
+                attempts = p.attempts + (r.retry_in IS NOT NULL)::int,
+                retry_at = now() + make_interval(secs => r.retry_in),
+                processed_at = CASE WHEN r.retry_in IS NULL THEN now() END,
+                claimed_at = NULL
+            FROM unnest($1::bigint[], $2::bigint[], $3::varchar[], $4::text[], $5::float8[])
+                AS r(chat_id, user_id, status, error, retry_in)
+            WHERE p.chat_id = r.chat_id AND p.user_id = r.user_id AND p.status = 'processing'
+        ''', *(list(column) for column in zip(*results)))
+
+
+async def count_open_join_requests() -> dict:
+    async with pool.acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT status, COUNT(*) AS count FROM pending_join_requests
+            WHERE status IN ('pending', 'verified', 'processing')
+            GROUP BY status
+        ''')
+    return {row['status']: row['count'] for row in rows}
 
 
 async def get_user(user_id: int):
@@ -78,17 +666,533 @@ async def get_user(user_id: int):
         )
 
 
+async def get_users_page(limit: int, before=None, after=None):
+    """Страница пользователей от новых к старым, keyset по (created_at, id).
+
+    before - курсор (created_at, id): строки старше него (следующая страница),
+    after - строки новее него (предыдущая страница). Возвращает до limit строк
+    в порядке от новых к старым.
+    """
+    columns = 'id, user_id, username, first_name, last_name, created_at'
+    async with pool.acquire() as conn:
+        if after:
+            rows = await conn.fetch(f'''
+                SELECT {columns} FROM users
+                WHERE (created_at, id) > ($1, $2)
+                ORDER BY created_at, id
+                LIMIT $3
+            ''', after[0], after[1], limit)
+            return list(reversed(rows))
+        if before:
+            return await conn.fetch(f'''
+                SELECT {columns} FROM users
+                WHERE (created_at, id) < ($1, $2)
+                ORDER BY created_at DESC, id DESC
+                LIMIT $3
+            ''', before[0], before[1], limit)
+        return await conn.fetch(f'''
+            SELECT {columns} FROM users
+            ORDER BY created_at DESC, id DESC
+            LIMIT $1
+        ''', limit)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+BIGINT_MAX = 2 ** 63 - 1
+
+
+async def search_users(query: str, limit: int = 10, offset: int = 0):
+    """Ищет пользователей по username, имени и фамилии.
+
+    Сначала точное совпадение username или user_id, затем совпадения с начала
+    username, затем остальные по убыванию сходства (pg_trgm).
+    """
+    query = query.strip().lstrip('@').lower()
+    if not query:
+        return []
+    pattern = _escape_like(query)
+    # isdigit() пропускает и не-ASCII цифры ('²'), которые int() не разбирает
+    exact_id = int(query) if query.isascii() and query.isdigit() else None
+    if exact_id is not None and exact_id > BIGINT_MAX:
+        exact_id = None
+    if search_trgm_available:
+        sql = f'''
+            SELECT id, user_id, username, first_name, last_name, created_at
+            FROM users
+            WHERE {USER_SEARCH_EXPR} LIKE '%' || $1 || '%' OR user_id = $4
+            ORDER BY user_id = $4 DESC NULLS LAST,
+                     lower(username) = $5 DESC NULLS LAST,
+                     lower(username) LIKE $1 || '%' DESC NULLS LAST,
+                     similarity({USER_SEARCH_EXPR}, $5) DESC,
+                     id
+            LIMIT $2 OFFSET $3
+        '''
+    else:
+        # Диапазон вместо LIKE 'x%': индекс text_pattern_ops используется и в общем плане
+        sql = '''
+            SELECT id, user_id, username, first_name, last_name, created_at
+            FROM users
+            WHERE (lower(username) ~>=~ $1 AND lower(username) ~<~ $5)
+               OR (lower(first_name) ~>=~ $1 AND lower(first_name) ~<~ $5)
+               OR (lower(last_name) ~>=~ $1 AND lower(last_name) ~<~ $5)
+               OR user_id = $4
+            ORDER BY user_id = $4 DESC NULLS LAST,
+                     lower(username) = $1 DESC NULLS LAST,
+                     (lower(username) ~>=~ $1 AND lower(username) ~<~ $5) DESC NULLS LAST,
+                     id
+            LIMIT $2 OFFSET $3
+        '''
+    async with pool.acquire() as conn:
+        if search_trgm_available:
+            return await conn.fetch(sql, pattern, limit, offset, exact_id, query)
+        upper_bound = query[:-1] + chr(ord(query[-1]) + 1)
+        return await conn.fetch(sql, query, limit, offset, exact_id, upper_bound)
+
+
 async def get_all_users():
     async with pool.acquire() as conn:
         return await conn.fetch('SELECT * FROM users ORDER BY created_at DESC')
 
 
-async def save_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    return await get_or_create_user(user_id, username, first_name, last_name)
+async def get_user_counters():
+    """Все счетчики пользователей одним проходом по таблице"""
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(USER_COUNTERS_SQL)
+
+
+async def get_db_timezone() -> str:
+    """Часовой пояс сессии БД: в нем считаются CURRENT_DATE и created_at"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT current_setting('TimeZone')")
+
+
+async def get_signup_histogram(days: int):
+    """Регистрации по дням за последние days дней, включая дни без регистраций"""
+    async with pool.acquire() as conn:
+        return await conn.fetch('''
+            SELECT d::date AS day, COUNT(u.id) AS signups
+            FROM generate_series(CURRENT_DATE - ($1::int - 1), CURRENT_DATE, interval '1 day') AS d
+            LEFT JOIN users u ON u.created_at >= d AND u.created_at < d + interval '1 day'
+            GROUP BY d
+            ORDER BY d
+        ''', days)
+
+
+def build_segment_filter(segment: dict = None, first_param: int = 1):
+    """Сегмент аудитории -> (условие WHERE по users, параметры с номера first_param).
+
+    Ключи сегмента: reachable_only (по умолчанию True), date_from / date_to
+    (ISO-даты регистрации, включительно), has_username, source (см. USER_SOURCES),
+    user_ids, min_user_id. По индексам идут delivery_status (users_reachable_idx),
+    даты (users_created_at_id_idx) и user_id (уникальный индекс); has_username и
+    source мало что отсекают и проверяются по строкам, отобранным остальными условиями.
+    """
+    segment = segment or {}
+    conditions = []
+    args = []
+
+    def param(value) -> str:
+        args.append(value)
+        return f'${first_param + len(args) - 1}'
+
+    if segment.get('reachable_only', True):
+        conditions.append("delivery_status = 'active'")
+    if segment.get('date_from'):
+        conditions.append(f"created_at >= {param(date.fromisoformat(segment['date_from']))}::date")
+    if segment.get('date_to'):
+        conditions.append(f"created_at < {param(date.fromisoformat(segment['date_to']))}::date + 1")
+    if segment.get('has_username'):
+        conditions.append("username IS NOT NULL")
+    if segment.get('source'):
+        conditions.append(f"source = {param(segment['source'])}")
+    if segment.get('user_ids') is not None:
+        conditions.append(f"user_id = ANY({param(segment['user_ids'])}::bigint[])")
+    if segment.get('min_user_id') is not None:
+        conditions.append(f"user_id >= {param(segment['min_user_id'])}")
+    return ' AND '.join(conditions) or 'TRUE', args
+
+
+async def count_audience(segment: dict = None) -> int:
+    condition, args = build_segment_filter(segment)
+    async with pool.acquire() as conn:
+        return await conn.fetchval(f'SELECT COUNT(*) FROM users WHERE {condition}', *args)
+
+
+async def mark_users_undeliverable(failures):
+    """Сохраняет постоянные ошибки доставки: список пар (user_id, delivery_status)"""
+    if not failures:
+        return
+    forget_profiles(user_id for user_id, _ in failures)
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            UPDATE users u
+            SET delivery_status = f.status, last_failure_at = CURRENT_TIMESTAMP
+            FROM unnest($1::bigint[], $2::varchar[]) AS f(user_id, status)
+            WHERE u.user_id = f.user_id
+        ''', [f[0] for f in failures], [f[1] for f in failures])
+
+
+async def create_broadcast_job(admin_id: int, payload: dict, segment: dict = None,
+                               start_at: datetime = None, window_end: datetime = None):
+    """Создает задание рассылки и фиксирует список получателей сегмента одним INSERT ... SELECT.
+
+    С start_at в будущем задание создается в статусе scheduled и запускается планировщиком.
+    """
+    condition, args = build_segment_filter(segment, first_param=2)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval('''
+                INSERT INTO broadcast_jobs (admin_id, payload, status, start_at, window_end)
+                VALUES ($1, $2, CASE WHEN $3::timestamptz > now() THEN 'scheduled' ELSE 'running' END, $3, $4)
+                RETURNING id
+            ''', admin_id, payload, start_at, window_end)
+            result = await conn.execute(
+                f'INSERT INTO broadcast_recipients (job_id, user_id) '
+                f'SELECT $1, user_id FROM users WHERE {condition}',
+                job_id, *args
+            )
+            total = int(result.split()[-1])
+            return await conn.fetchrow(
+                'UPDATE broadcast_jobs SET total = $2 WHERE id = $1 RETURNING *',
+                job_id, total
+            )
+
+
+async def get_broadcast_job(job_id: int):
+    async with pool.acquire() as conn:
+        return await conn.fetchrow('SELECT * FROM broadcast_jobs WHERE id = $1', job_id)
+
+
+async def get_unfinished_broadcast_jobs():
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            "SELECT * FROM broadcast_jobs WHERE status IN ('running', 'paused', 'scheduled') ORDER BY id"
+        )
+
+
+async def claim_due_broadcast_jobs():
+    """Переводит наступившие запланированные задания в running и возвращает их.
+
+    UPDATE атомарен, поэтому при нескольких процессах каждое задание получит один.
+    """
+    async with pool.acquire() as conn:
+        return await conn.fetch('''
+            UPDATE broadcast_jobs
+            SET status = 'running', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'scheduled' AND start_at <= now()
+            RETURNING *
+        ''')
+
+
+async def set_broadcast_job_message(job_id: int, chat_id: int, message_id: int):
+    async with pool.acquire() as conn:
+        await conn.execute(
+            'UPDATE broadcast_jobs SET status_chat_id = $2, status_message_id = $3 WHERE id = $1',
+            job_id, chat_id, message_id
+        )
+
+
+async def set_broadcast_job_status(job_id: int, status: str, from_statuses=('running', 'paused')):
+    """Меняет статус задания, только если текущий статус входит в from_statuses"""
+    async with pool.acquire() as conn:
+        return await conn.fetchrow('''
+            UPDATE broadcast_jobs
+            SET status = $2, updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN $2::varchar IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END
+            WHERE id = $1 AND status = ANY($3::varchar[])
+            RETURNING *
+        ''', job_id, status, list(from_statuses))
+
+
+async def iter_broadcast_recipients(job_id: int, page_size: int = AUDIENCE_PAGE_SIZE):
+    """Отдает еще не обработанных получателей задания страницами по user_id"""
+    last_user_id = None
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(RECIPIENTS_PAGE_SQL, job_id, last_user_id, page_size)
+        if not rows:
+            return
+        last_user_id = rows[-1]['user_id']
+        yield [row['user_id'] for row in rows]
+        if len(rows) < page_size:
+            return
+
+
+async def save_broadcast_results(job_id: int, results) -> str:
+    """Сохраняет пакет результатов (user_id, error, attempts) и возвращает текущий статус задания.
+
+    error=None означает успешную доставку. Счетчики задания обновляются тем же запросом.
+    """
+    async with pool.acquire() as conn:
+        return await conn.fetchval('''
+            WITH results AS (
+                SELECT * FROM unnest($2::bigint[], $3::text[], $4::smallint[]) AS r(user_id, error, attempts)
+            ), updated AS (
+                UPDATE broadcast_recipients br
+                SET status = CASE WHEN r.error IS NULL THEN 'sent' ELSE 'failed' END,
+                    error = r.error,
+                    attempts = r.attempts,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM results r
+                WHERE br.job_id = $1 AND br.user_id = r.user_id AND br.status IN ('pending', 'claimed')
+                RETURNING br.status, br.attempts
+            )
+            UPDATE broadcast_jobs
+            SET sent = sent + (SELECT COUNT(*) FROM updated WHERE status = 'sent'),
+                failed = failed + (SELECT COUNT(*) FROM updated WHERE status = 'failed'),
+                retried = retried + (SELECT COUNT(*) FROM updated WHERE status = 'sent' AND attempts > 1),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1
+            RETURNING status
+        ''', job_id, [r[0] for r in results], [r[1] for r in results], [r[2] for r in results])
+
+
+CLAIM_RECIPIENTS_SQL = '''
+    UPDATE broadcast_recipients br
+    SET status = 'claimed', claimed_by = $3, claimed_at = clock_timestamp()
+    FROM (
+        SELECT user_id FROM broadcast_recipients
+        WHERE job_id = $1 AND {condition}
+        ORDER BY user_id LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    ) c
+    WHERE br.job_id = $1 AND br.user_id = c.user_id
+    RETURNING br.user_id
+'''
+
+
+async def claim_broadcast_recipients(job_id: int, limit: int, worker: str, lease: float):
+    """Забирает до limit необработанных получателей задания для процесса worker.
+
+    SKIP LOCKED: параллельные процессы получают разные пачки, не дожидаясь друг друга.
+    Если свободных pending не хватило, добираются пачки, аренда которых истекла.
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            CLAIM_RECIPIENTS_SQL.format(condition="status = 'pending' AND $4::float8 IS NOT NULL"),
+            job_id, limit, worker, lease
+        )
+        if len(rows) < limit:
+            rows += await conn.fetch(
+                CLAIM_RECIPIENTS_SQL.format(
+                    condition="status = 'claimed' AND claimed_at < clock_timestamp() - make_interval(secs => $4)"
+                ),
+                job_id, limit - len(rows), worker, lease
+            )
+    return sorted(row['user_id'] for row in rows)
+
+
+async def release_broadcast_recipients(job_id: int, worker: str) -> int:
+    """Возвращает в pending получателей, которых процесс забрал, но не обработал"""
+    async with pool.acquire() as conn:
+        result = await conn.execute('''
+            UPDATE broadcast_recipients
+            SET status = 'pending', claimed_by = NULL, claimed_at = NULL
+            WHERE job_id = $1 AND status = 'claimed' AND claimed_by = $2
+        ''', job_id, worker)
+    return int(result.split()[-1])
+
+
+async def get_job_delivery_state(job_id: int):
+    """Осталось получателей, окно доставки и сколько процессов сейчас держат пачки задания"""
+    async with pool.acquire() as conn:
+        return await conn.fetchrow('''
+            SELECT j.total - j.sent - j.failed AS remaining, j.window_end,
+                   (SELECT COUNT(DISTINCT claimed_by) FROM broadcast_recipients
+                    WHERE job_id = $1 AND status = 'claimed') AS workers
+            FROM broadcast_jobs j WHERE j.id = $1
+        ''', job_id)
+
+
+async def get_running_broadcast_jobs():
+    async with pool.acquire() as conn:
+        return await conn.fetch("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+
+
+TAKE_SEND_BUDGET_SQL = '''
+    WITH b AS (
+        SELECT tokens, updated_at, clock_timestamp() AS now,
+               CASE WHEN rate_updated_at > clock_timestamp() - interval '10 seconds'
+                    THEN rate ELSE $1::float8 END AS rate
+        FROM send_budget WHERE id = 1
+        FOR UPDATE
+    ), s AS (
+        SELECT now, updated_at, rate,
+               LEAST($2::float8, tokens + GREATEST(EXTRACT(EPOCH FROM now - updated_at)::float8, 0) * rate)
+                   AS available
+        FROM b
+    )
+    UPDATE send_budget
+    SET tokens = s.available - LEAST(floor(s.available), $3),
+        updated_at = GREATEST(s.now, s.updated_at)
+    FROM s
+    WHERE id = 1
+    RETURNING LEAST(floor(s.available), $3)::int AS granted,
+              GREATEST(EXTRACT(EPOCH FROM s.updated_at - s.now)::float8, 0)
+                  + GREATEST(1 - s.available, 0) / s.rate AS wait
+'''
+
+
+async def take_send_budget(rate: float, capacity: float, count: int):
+    """Берет до count токенов из общего бакета send_budget.
+
+    Возвращает (выдано, сколько секунд ждать до следующего токена). rate -
+    скорость по умолчанию, если бот не выставил свою через set_send_budget_rate.
+    """
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(TAKE_SEND_BUDGET_SQL, rate, capacity, count)
+    return row['granted'], row['wait']
+
+
+async def pause_send_budget(seconds: float):
+    """Останавливает выдачу токенов всем процессам (429 с retry_after)"""
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            UPDATE send_budget
+            SET tokens = 0, updated_at = GREATEST(updated_at, clock_timestamp() + make_interval(secs => $1))
+            WHERE id = 1
+        ''', seconds)
+
+
+async def set_send_budget_rate(rate: float):
+    """Скорость общего бакета; действует 10 секунд, поэтому ее нужно обновлять периодически"""
+    async with pool.acquire() as conn:
+        await conn.execute(
+            'UPDATE send_budget SET rate = $1, rate_updated_at = clock_timestamp() WHERE id = 1', rate
+        )
+
+
+async def finish_broadcast_job(job_id: int):
+    """Помечает задание выполненным, если не осталось необработанных получателей"""
+    async with pool.acquire() as conn:
+        await conn.execute('''
+            UPDATE broadcast_jobs
+            SET status = 'done', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = $1 AND status = 'running' AND NOT EXISTS (
+                SELECT 1 FROM broadcast_recipients WHERE job_id = $1 AND status IN ('pending', 'claimed')
+            )
+        ''', job_id)
+        return await conn.fetchrow('SELECT * FROM broadcast_jobs WHERE id = $1', job_id)
+
+
+async def save_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                    reactivate: bool = False, source: str = None):
+    """Сохраняет профиль; None, если он не изменился (кэш или БД) или ушел в очередь write-behind"""
+    cache = USER_CACHE_SIZE > 0
+    if cache:
+        profile_hash = hash((username, first_name, last_name))
+        if _profile_unchanged(user_id, profile_hash, reactivate):
+            return None
+    if _flush_task:
+        queue_user(user_id, username, first_name, last_name, reactivate, source)
+        user = None
+    else:
+        user = await get_or_create_user(user_id, username, first_name, last_name, reactivate, source)
+    if cache:
+        _remember_profile(user_id, profile_hash, reactivate or bool(user and user['delivery_status'] == 'active'))
+    return user
+
+
+async def listen(channel: str, callback):
+    """Отдельное соединение вне пула, подписанное на канал NOTIFY"""
+    conn = await asyncpg.connect(
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        host=DB_HOST,
+        port=DB_PORT
+    )
+    await conn.add_listener(channel, callback)
+    return conn
+
+
+# Первая половина ключа advisory-лока задания рассылки (вторая - id задания)
+BROADCAST_JOB_LOCK_SPACE = 0x6272
+
+
+async def lock_broadcast_job(job_id: int):
+    """Берет задание рассылки во владение процесса: advisory-лок на отдельном соединении.
+
+    Возвращает соединение (закрыть его - отпустить задание) или None, если
+    задание уже рассылает другой процесс. Лок держится, пока соединение живо,
+    поэтому упавший процесс отпускает задание сам.
+    """
+    conn = await asyncpg.connect(
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        host=DB_HOST,
+        port=DB_PORT,
+        server_settings={'application_name': 'bot-broadcast'}
+    )
+    try:
+        locked = await conn.fetchval('SELECT pg_try_advisory_lock($1, $2)', BROADCAST_JOB_LOCK_SPACE, job_id)
+    except BaseException:
+        await conn.close()
+        raise
+    if not locked:
+        await conn.close()
+        return None
+    return conn
+
+
+EXPORT_USERS_SQL = '''
+    SELECT user_id, username, first_name, last_name, source, delivery_status, created_at, updated_at
+    FROM users ORDER BY user_id
+'''
+
+
+async def export_users(output) -> int:
+    """Выгружает users в CSV через COPY TO STDOUT; output - корутина, получающая куски bytes.
+
+    Работает на отдельном соединении вне пула, чтобы долгая выгрузка не занимала
+    соединения обработчиков. Снимок согласованный (REPEATABLE READ, только чтение).
+    Возвращает число строк.
+    """
+    conn = await asyncpg.connect(
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        host=DB_HOST,
+        port=DB_PORT,
+        server_settings={'application_name': 'bot-export'}
+    )
+    try:
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            result = await conn.copy_from_query(EXPORT_USERS_SQL, output=output, format='csv', header=True)
+    finally:
+        await conn.close()
+    return int(result.split()[-1])
+
+
+async def ping(timeout: float = 5) -> float:
+    """Проверка БД: время получения соединения и SELECT 1, секунды"""
+    started = time.perf_counter()
+    async with pool.acquire(timeout=timeout) as conn:
+        await conn.fetchval('SELECT 1', timeout=timeout)
+    return time.perf_counter() - started
+
+
+def get_pool_stats() -> dict:
+    return pool.stats() if pool else {}
 
 
 async def close_db():
-    global pool
+    global pool, _flush_task
+    if _flush_task:
+        # Цикл доделывает текущую запись и выходит; остаток очереди пишется ниже
+        _flush_stop.set()
+        _flush_event.set()
+        try:
+            await _flush_task
+        except Exception as e:
+            logger.error("Ошибка write-behind при остановке: %s", e,
+                         extra={'error_class': type(e).__name__})
+        _flush_task = None
+        await flush_pending_users()
     if pool:
         await pool.close()
-        print("[LOG] Подключение к базе данных закрыто") 
\ No newline at end of file
+        logger.info("Подключение к базе данных закрыто") 
\ No newline at end of file
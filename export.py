@@ -0,0 +1,43 @@
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+import time
+import database
+
+logger = logging.getLogger(__name__)
+
+# Каталог для временных файлов выгрузки; по умолчанию системный
+EXPORT_DIR = os.getenv('EXPORT_DIR') or None
+EXPORT_COMPRESSION_LEVEL = int(os.getenv('EXPORT_COMPRESSION_LEVEL', 6))
+# Облачный Bot API принимает документы до 50 МБ, локальный сервер - до 2000 МБ
+EXPORT_MAX_FILE_SIZE = int(os.getenv('EXPORT_MAX_FILE_SIZE', 50 * 1024 * 1024))
+
+# Одновременно идет только одна выгрузка
+export_lock = asyncio.Lock()
+
+
+async def export_users_file() -> tuple:
+    """Выгружает пользователей в сжатый CSV во временный файл; возвращает (путь, число строк).
+
+    Куски COPY сразу сжимаются и пишутся на диск, поэтому память не растет
+    с размером таблицы. Сжатие идет в потоке, чтобы не занимать event loop.
+    Файл удаляет вызывающий.
+    """
+    started = time.monotonic()
+    tmp = tempfile.NamedTemporaryFile(prefix='users_', suffix='.csv.gz', dir=EXPORT_DIR, delete=False)
+    try:
+        with gzip.GzipFile(fileobj=tmp, mode='wb', compresslevel=EXPORT_COMPRESSION_LEVEL) as archive:
+            async def write(chunk: bytes):
+                await asyncio.to_thread(archive.write, chunk)
+
+            rows = await database.export_users(write)
+        tmp.close()
+    except BaseException:
+        tmp.close()
+        os.remove(tmp.name)
+        raise
+    logger.info("Выгрузка пользователей: %d строк, %.1f КБ за %.1fс", rows,
+                os.path.getsize(tmp.name) / 1024, time.monotonic() - started)
+    return tmp.name, rows
@@ -0,0 +1,144 @@
+import asyncio
+import copy
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+import database
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд доверять локальной копии состояния. Другой процесс мог изменить
+# запись за это время, поэтому значение держим маленьким
+FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', 2))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 1000))
+# Через сколько секунд без изменений черновик считается брошенным
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 24 * 60 * 60))
+FSM_CLEANUP_INTERVAL = float(os.getenv('FSM_CLEANUP_INTERVAL', 600))
+
+# Запись, не менявшаяся дольше FSM_STATE_TTL, считается отсутствующей
+_FRESH = "updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2)"
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_states на общем пуле asyncpg.
+
+    Данные хранятся в JSONB, поэтому в них должны быть только JSON-совместимые
+    значения (модели aiogram сериализуются через model_dump).
+    """
+
+    def __init__(self, cache_ttl: float = FSM_CACHE_TTL, cache_size: int = FSM_CACHE_SIZE,
+                 state_ttl: int = FSM_STATE_TTL):
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.state_ttl = state_ttl
+        self._cache = OrderedDict()
+        self._cleanup_task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def _remember(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        self._cache[key] = (time.monotonic(), state, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str):
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            return cached[1], cached[2]
+        async with database.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                f'SELECT state, data FROM fsm_states WHERE key = $1 AND {_FRESH}',
+                key, self.state_ttl
+            )
+        state, data = (row['state'], row['data']) if row else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        key = self._key(key)
+        async with database.pool.acquire() as conn:
+            row = await conn.fetchrow(f'''
+                INSERT INTO fsm_states (key, state) VALUES ($1, $3)
+                ON CONFLICT (key) DO UPDATE
+                SET state = EXCLUDED.state,
+                    data = CASE WHEN fsm_states.{_FRESH} THEN fsm_states.data ELSE '{{}}'::jsonb END,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING data
+            ''', key, self.state_ttl, state)
+        self._remember(key, state, row['data'])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        key = self._key(key)
+        data = dict(data)
+        async with database.pool.acquire() as conn:
+            row = await conn.fetchrow(f'''
+                INSERT INTO fsm_states (key, data) VALUES ($1, $3)
+                ON CONFLICT (key) DO UPDATE
+                SET data = EXCLUDED.data,
+                    state = CASE WHEN fsm_states.{_FRESH} THEN fsm_states.state END,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING state, data
+            ''', key, self.state_ttl, data)
+        self._remember(key, row['state'], row['data'])
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return copy.deepcopy(data)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        # Слияние делает сам Postgres (jsonb ||), без гонки чтение-изменение-запись
+        key = self._key(key)
+        async with database.pool.acquire() as conn:
+            row = await conn.fetchrow(f'''
+                INSERT INTO fsm_states (key, data) VALUES ($1, $3)
+                ON CONFLICT (key) DO UPDATE
+                SET data = CASE WHEN fsm_states.{_FRESH} THEN fsm_states.data || EXCLUDED.data
+                                ELSE EXCLUDED.data END,
+                    state = CASE WHEN fsm_states.{_FRESH} THEN fsm_states.state END,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING state, data
+            ''', key, self.state_ttl, dict(data))
+        self._remember(key, row['state'], row['data'])
+        return copy.deepcopy(row['data'])
+
+    async def delete_expired(self) -> int:
+        async with database.pool.acquire() as conn:
+            result = await conn.execute(
+                'DELETE FROM fsm_states WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1)',
+                self.state_ttl
+            )
+        return int(result.split()[-1])
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+            try:
+                deleted = await self.delete_expired()
+                if deleted:
+                    logger.info("Удалено брошенных FSM-состояний: %d", deleted)
+            except Exception:
+                logger.exception("Ошибка очистки FSM-состояний")
+
+    def start_cleanup(self):
+        if not self._cleanup_task:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self) -> None:
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+        self._cache.clear()
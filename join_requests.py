@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.types import ChatJoinRequest
+from rate_limiter import TokenBucket
+import database
+
+logger = logging.getLogger(__name__)
+
+JOIN_QUEUE_SIZE = int(os.getenv('JOIN_QUEUE_SIZE', 10000))
+JOIN_WORKERS = int(os.getenv('JOIN_WORKERS', 4))
+# Повторная заявка того же пользователя в течение окна (секунды) отбрасывается
+JOIN_DEDUP_WINDOW = float(os.getenv('JOIN_DEDUP_WINDOW', 60))
+
+# Одобрение заявок: запросов к API в секунду, одновременных запросов, размер пачки
+JOIN_APPROVE_RATE = float(os.getenv('JOIN_APPROVE_RATE', 20))
+JOIN_APPROVE_CONCURRENCY = int(os.getenv('JOIN_APPROVE_CONCURRENCY', 8))
+JOIN_APPROVE_BATCH = int(os.getenv('JOIN_APPROVE_BATCH', 100))
+# Как часто проверять заявки, если никто не проходил проверку, секунды
+JOIN_APPROVE_INTERVAL = float(os.getenv('JOIN_APPROVE_INTERVAL', 10))
+# Заявки без проверки старше этого (секунды) отклоняются; 0 - не отклонять
+JOIN_REQUEST_TTL = float(os.getenv('JOIN_REQUEST_TTL', 24 * 60 * 60))
+# Через сколько секунд незакрытую забранную заявку можно забрать снова
+JOIN_APPROVE_LEASE = float(os.getenv('JOIN_APPROVE_LEASE', 300))
+JOIN_APPROVE_MAX_RETRY_AFTER = 3
+# Временные ошибки (сеть, 5xx, потеря прав админа): попыток на заявку и задержки
+# между ними, секунды (экспонента от базовой до максимальной)
+JOIN_APPROVE_MAX_ATTEMPTS = int(os.getenv('JOIN_APPROVE_MAX_ATTEMPTS', 10))
+JOIN_APPROVE_RETRY_DELAY = float(os.getenv('JOIN_APPROVE_RETRY_DELAY', 30))
+JOIN_APPROVE_RETRY_MAX_DELAY = float(os.getenv('JOIN_APPROVE_RETRY_MAX_DELAY', 3600))
+
+# Ответы API, означающие, что заявки уже нет: пользователь в канале или отозвал ее
+JOIN_REQUEST_GONE_ERRORS = {
+    "USER_ALREADY_PARTICIPANT": 'approved',
+    "HIDE_REQUESTER_MISSING": 'gone'
+}
+# Bad Request, который проходит сам: у бота временно нет прав админа в канале
+JOIN_REQUEST_RETRY_ERRORS = ("CHAT_ADMIN_REQUIRED", "not enough rights")
+
+
+class JoinRequestQueue:
+    """Очередь заявок на вступление: обработчик только ставит заявку в очередь,
+    process_func выполняют JOIN_WORKERS воркеров.
+
+    Очередь ограничена: при переполнении submit() ждет, и нагрузка упирается
+    в прием апдейтов, а не в пул БД и лимиты API.
+    """
+
+    def __init__(self, process_func, workers: int = JOIN_WORKERS, maxsize: int = JOIN_QUEUE_SIZE,
+                 dedup_window: float = JOIN_DEDUP_WINDOW):
+        self.process_func = process_func
+        self.workers = workers
+        self.dedup_window = dedup_window
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._seen = OrderedDict()
+        self._tasks = []
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.processed = 0
+        self.failed = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    def _is_duplicate(self, user_id: int) -> bool:
+        now = time.monotonic()
+        # Записи упорядочены по времени, устаревшие всегда в начале
+        while self._seen:
+            seen_at = next(iter(self._seen.values()))
+            if now - seen_at < self.dedup_window:
+                break
+            self._seen.popitem(last=False)
+        if user_id in self._seen:
+            return True
+        self._seen[user_id] = now
+        return False
+
+    async def submit(self, event: ChatJoinRequest) -> bool:
+        """Ставит заявку в очередь; False, если это повтор в окне дедупликации"""
+        if self._is_duplicate(event.from_user.id):
+            self.deduplicated += 1
+            logger.debug("Повторная заявка отброшена", extra={'user_id': event.from_user.id})
+            return False
+        await self._queue.put((time.monotonic(), event))
+        self.enqueued += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            enqueued_at, event = await self._queue.get()
+            wait = time.monotonic() - enqueued_at
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_wait += wait
+            try:
+                await self.process_func(event)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception("Ошибка обработки заявки",
+                                 extra={'user_id': event.from_user.id, 'error_class': type(e).__name__})
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            logger.info("Очередь заявок запущена: воркеров %d, размер %d", self.workers, self._queue.maxsize)
+
+    async def stop(self, timeout: float = 10):
+        """Дает воркерам дообработать очередь, затем останавливает их"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь заявок не обработана до конца: осталось %d", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def metrics(self) -> dict:
+        taken = self.processed + self.failed
+        return {
+            'depth': self.depth,
+            'enqueued': self.enqueued,
+            'deduplicated': self.deduplicated,
+            'processed': self.processed,
+            'failed': self.failed,
+            'last_wait': self.last_wait,
+            'max_wait': self.max_wait,
+            'avg_wait': self.total_wait / taken if taken else 0.0
+        }
+
+
+class JoinRequestApprover:
+    """Фоновое одобрение заявок из pending_join_requests.
+
+    Проверенные заявки одобряются, непроверенные дольше JOIN_REQUEST_TTL -
+    отклоняются. Заявки берутся пачками, запросы к API ограничены токен-бакетом
+    и не более concurrency одновременно, поэтому накопившаяся очередь
+    разбирается за минуты и не упирается в лимиты. wake() запускает проход сразу.
+    После временных ошибок (сеть, 5xx, нет прав админа) заявка откладывается и
+    повторяется; failed ставится только на окончательный Bad Request.
+    """
+
+    def __init__(self, bot: Bot, rate: float = JOIN_APPROVE_RATE, concurrency: int = JOIN_APPROVE_CONCURRENCY,
+                 batch_size: int = JOIN_APPROVE_BATCH, interval: float = JOIN_APPROVE_INTERVAL,
+                 expire_after: float = JOIN_REQUEST_TTL):
+        self.bot = bot
+        self.limiter = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.interval = interval
+        self.expire_after = expire_after
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Снимок незакрытых заявок по статусам для панели статистики; обновляется
+        # в фоне не чаще раза в interval, чтобы панель не ходила в БД
+        self.open_requests = {}
+        self._counted_at = 0.0
+        # (action, итоговый статус) -> число заявок
+        self.results = Counter()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _call(self, request):
+        chat_id, user_id, action = request['chat_id'], request['user_id'], request['action']
+        method = self.bot.approve_chat_join_request if action == 'approve' else self.bot.decline_chat_join_request
+        for attempt in range(JOIN_APPROVE_MAX_RETRY_AFTER):
+            await self.limiter.acquire()
+            try:
+                await method(chat_id=chat_id, user_id=user_id)
+                return 'approved' if action == 'approve' else 'declined', None
+            except TelegramRetryAfter as e:
+                logger.warning("⏸ Лимит Telegram при одобрении заявок, пауза %sс", e.retry_after)
+                self.limiter.pause(e.retry_after)
+                # После последней паузы заявка откладывается (см. process_batch)
+                if attempt == JOIN_APPROVE_MAX_RETRY_AFTER - 1:
+                    raise
+            except TelegramBadRequest as e:
+                for marker, status in JOIN_REQUEST_GONE_ERRORS.items():
+                    if marker in str(e):
+                        return status, None
+                raise
+
+    @staticmethod
+    def _retry_in(request, error: Exception):
+        """Через сколько секунд повторить заявку после ошибки; None - ошибка окончательная"""
+        if isinstance(error, TelegramBadRequest) and not any(
+                marker in str(error) for marker in JOIN_REQUEST_RETRY_ERRORS):
+            return None
+        if request['attempts'] + 1 >= JOIN_APPROVE_MAX_ATTEMPTS:
+            return None
+        delay = min(JOIN_APPROVE_RETRY_MAX_DELAY, JOIN_APPROVE_RETRY_DELAY * 2 ** request['attempts'])
+        if isinstance(error, TelegramRetryAfter):
+            delay = max(delay, error.retry_after)
+        return delay
+
+    async def process_batch(self) -> int:
+        """Один проход: забирает пачку и закрывает ее; возвращает размер пачки"""
+        requests = await database.claim_join_requests(self.batch_size, self.expire_after, JOIN_APPROVE_LEASE)
+        if not requests:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def handle(request):
+            async with semaphore:
+                retry_in = None
+                try:
+                    status, error = await self._call(request)
+                except Exception as e:
+                    retry_in = self._retry_in(request, e)
+                    status, error = 'failed' if retry_in is None else 'retry', str(e)
+                    if retry_in is None:
+                        logger.warning("Не удалось обработать заявку (%s): %s", request['action'], e,
+                                       extra={'user_id': request['user_id'], 'error_class': type(e).__name__})
+                    else:
+                        logger.debug("Заявка (%s) отложена на %.0fс: %s", request['action'], retry_in, e,
+                                    extra={'user_id': request['user_id'], 'error_class': type(e).__name__})
+                self.results[(request['action'], status)] += 1
+                return request['chat_id'], request['user_id'], status, error, retry_in
+
+        results = await asyncio.gather(*(handle(request) for request in requests))
+        await database.finish_join_requests(results)
+        logger.info("Обработано заявок: %d (одобрено %d, отложено %d)", len(results),
+                    sum(1 for result in results if result[2] == 'approved'),
+                    sum(1 for result in results if result[2] == 'retry'))
+        return len(requests)
+
+    async def _refresh_open_requests(self):
+        if time.monotonic() - self._counted_at < self.interval:
+            return
+        self._counted_at = time.monotonic()
+        self.open_requests = await database.count_open_join_requests()
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._refresh_open_requests()
+                # Полная пачка - вероятно, есть еще: продолжаем без паузы
+                if await self.process_batch() >= self.batch_size:
+                    continue
+            except Exception as e:
+                logger.exception("Ошибка обработки заявок", extra={'error_class': type(e).__name__})
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._loop())
+            logger.info("Одобрение заявок запущено: %.0f запросов/с, одновременно %d",
+                        self.limiter.rate, self.concurrency)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
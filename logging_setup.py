@@ -0,0 +1,102 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# text - строка с полями key=value, json - одна JSON-запись на строку
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# Доля успешных отправок рассылки, попадающих в лог (0 - ни одной, 1 - все).
+# Эти записи пишутся на уровне DEBUG, так что нужен еще LOG_LEVEL=DEBUG
+MAILING_LOG_SAMPLE_RATE = float(os.getenv('MAILING_LOG_SAMPLE_RATE', 0))
+
+# Поля, которые передаются через extra= и выводятся отдельно от текста
+STRUCTURED_FIELDS = ('user_id', 'job_id', 'error_class')
+
+_listener = None
+
+
+def _structured_fields(record: logging.LogRecord) -> dict:
+    return {
+        field: getattr(record, field)
+        for field in STRUCTURED_FIELDS
+        if getattr(record, field, None) is not None
+    }
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = _structured_fields(record)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(_structured_fields(record))
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей с extra={'sampled': True}"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampled', False):
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    # Стандартный prepare() форматирует запись в вызывающем потоке; оставляем это
+    # слушателю, чтобы в цикле событий была только постановка в очередь
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging():
+    """Настраивает корневой логгер: запись в очередь, вывод в stdout из отдельного потока"""
+    global _listener
+    if _listener:
+        return
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else StructuredFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = _LazyQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(MAILING_LOG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # aiogram на INFO пишет каждый обработанный апдейт
+    logging.getLogger('aiogram.event').setLevel(max(root.level, logging.WARNING))
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
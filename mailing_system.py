@@ -1,27 +1,161 @@
 from aiogram import Router, Bot, F
-from aiogram.types import ContentType
+from aiogram.types import ContentType, MessageEntity
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from rate_limiter import TokenBucket
+import database
+import metrics
 import asyncio
+import logging
+import datetime
+import heapq
+import os
+import random
+import re
+import time
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+# Telegram допускает около 30 сообщений в секунду разным пользователям
+MAILING_RATE_LIMIT = float(os.getenv('MAILING_RATE_LIMIT', 30))
+MAILING_WORKERS = int(os.getenv('MAILING_WORKERS', 16))
+MAILING_MAX_RETRY_AFTER = int(os.getenv('MAILING_MAX_RETRY_AFTER', 5))
+# Как часто (в секундах) обновлять сообщение с прогрессом рассылки
+MAILING_PROGRESS_INTERVAL = float(os.getenv('MAILING_PROGRESS_INTERVAL', 5))
+# Временные сбои (таймауты, 5xx, обрывы соединения) повторяются с экспоненциальной
+# задержкой: base * 2^(попытка-1), не больше max, со случайным разбросом
+MAILING_RETRY_ATTEMPTS = int(os.getenv('MAILING_RETRY_ATTEMPTS', 4))
+MAILING_RETRY_BASE_DELAY = float(os.getenv('MAILING_RETRY_BASE_DELAY', 2))
+MAILING_RETRY_MAX_DELAY = float(os.getenv('MAILING_RETRY_MAX_DELAY', 60))
+# Сколько результатов доставки копить перед записью чекпоинта в БД
+MAILING_CHECKPOINT_BATCH = int(os.getenv('MAILING_CHECKPOINT_BATCH', 200))
+# Сколько секунд ждать следующую часть альбома после последней пришедшей
+MAILING_ALBUM_DELAY = float(os.getenv('MAILING_ALBUM_DELAY', 1))
+
+# inprocess - задания рассылает сам бот; workers - процессы broadcast_worker.py,
+# а бот только показывает прогресс
+MAILING_EXECUTOR = os.getenv('MAILING_EXECUTOR', 'inprocess')
+
+# Часовой пояс, в котором админ задает время запланированной рассылки
+MAILING_TIMEZONE = ZoneInfo(os.getenv('MAILING_TIMEZONE', 'Europe/Moscow'))
+# Как часто пересчитывать темп окна доставки по оставшимся получателям, секунды
+DELIVERY_PACE_REFRESH = float(os.getenv('DELIVERY_PACE_REFRESH', 5))
+# Самое длинное окно доставки, часов
+MAILING_MAX_WINDOW_HOURS = 24 * 30
+
+# Максимум ID в загружаемом списке получателей и размер файла со списком
+MAILING_SEGMENT_MAX_IDS = int(os.getenv('MAILING_SEGMENT_MAX_IDS', 100000))
+MAILING_SEGMENT_MAX_FILE_SIZE = 5 * 1024 * 1024
+
+SEGMENT_SOURCE_TITLES = {
+    None: "все",
+    'join_request': "заявка в канал",
+    'start': "/start"
+}
+
+MAILING_CONTENT_TYPES = {
+    ContentType.TEXT, ContentType.PHOTO, ContentType.VIDEO, ContentType.DOCUMENT,
+    ContentType.ANIMATION, ContentType.AUDIO, ContentType.VOICE
+}
+
+# Общий бакет: параллельные рассылки делят один лимит бота
+mailing_limiter = TokenBucket(MAILING_RATE_LIMIT)
+
+# job_id -> (задача рассылки, событие остановки) для заданий этого процесса
+_job_runners = {}
+# job_id -> BroadcastProgress запущенных заданий, читается метрикой broadcast_remaining
+_job_progress = {}
+metrics.BROADCAST_REMAINING.set_function(
+    lambda: {(str(job_id),): progress.remaining for job_id, progress in _job_progress.items()}
+)
+
+# Постоянные ошибки доставки -> delivery_status пользователя
+PERMANENT_DELIVERY_ERRORS = {
+    "bot was blocked by the user": 'blocked',
+    "user is deactivated": 'deactivated',
+    "bot can't initiate conversation with a user": 'unreachable'
+}
+
+def classify_delivery_error(error_msg: str):
+    for marker, delivery_status in PERMANENT_DELIVERY_ERRORS.items():
+        if marker in error_msg:
+            return delivery_status
+    return None
+
+class RetryAfterExhausted(Exception):
+    """Telegram раз за разом отвечал 429 - сбой временный, попытку можно повторить позже"""
+
+# Ошибки, после которых отправку стоит повторить: сеть, 5xx Bot API, таймауты
+TRANSIENT_DELIVERY_ERRORS = (
+    TelegramNetworkError, TelegramServerError, RetryAfterExhausted, asyncio.TimeoutError, ConnectionError
+)
+
+def retry_delay(attempt: int) -> float:
+    """Задержка перед попыткой attempt + 1: экспонента с разбросом в половину величины"""
+    delay = min(MAILING_RETRY_MAX_DELAY, MAILING_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class BroadcastProgress:
+    """Счетчики рассылки: воркеры только увеличивают поля, расчеты делает репортер"""
+
+    def __init__(self, total: int, sent: int = 0, failed: int = 0, retried: int = 0):
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        # Доставлено со второй и следующих попыток / ждут повтора прямо сейчас
+        self.retried = retried
+        self.retrying = 0
+        self.rate = 0.0
+        self._sample_at = time.monotonic()
+        self._sample_done = sent + failed
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def remaining(self) -> int:
+        return max(self.total - self.done, 0)
+
+    def tick(self) -> float:
+        """Пересчитывает текущую скорость по приросту с прошлого вызова"""
+        now = time.monotonic()
+        done = self.done
+        if now > self._sample_at:
+            self.rate = (done - self._sample_done) / (now - self._sample_at)
+        self._sample_at, self._sample_done = now, done
+        return self.rate
+
+    @property
+    def eta(self):
+        rate = self.rate
+        return self.remaining / rate if rate > 0 else None
 
 class MailingStates(StatesGroup):
     waiting_for_content = State()
     preview_sent = State()
     waiting_for_button_text = State()
     waiting_for_button_url = State()
+    waiting_for_segment_dates = State()
+    waiting_for_segment_ids = State()
+    waiting_for_schedule = State()
 
-def get_mailing_confirmation_keyboard(buttons=None):
+def get_mailing_confirmation_keyboard(buttons=None, allow_buttons: bool = True):
     keyboard = []
     
     if buttons:
         for button in buttons:
             keyboard.append([InlineKeyboardButton(text=button['text'], url=button['url'])])
     
-    if not buttons or len(buttons) < 4:
+    if allow_buttons and (not buttons or len(buttons) < 4):
         keyboard.append([InlineKeyboardButton(text="➕ Добавить кнопку", callback_data="mailing:add_button")])
     
+    keyboard.append([InlineKeyboardButton(text="🎯 Аудитория", callback_data="mailing:segment")])
+    
     keyboard.append([
         InlineKeyboardButton(text="✅ Отправить", callback_data="mailing:confirm_send"),
         InlineKeyboardButton(text="❌ Отменить", callback_data="mailing:confirm_cancel")
@@ -29,143 +163,947 @@ def get_mailing_confirmation_keyboard(buttons=None):
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-async def process_mailing_content(message: Message, state: FSMContext):
-    if message.content_type == ContentType.TEXT:
-        user_text = message.text
-        entities = message.entities
-        
-        await state.update_data({
-            'content_type': ContentType.TEXT,
-            'text': user_text,
-            'entities': entities,
-            'buttons': []
-        })
-        
-        await message.answer(
-            user_text,
-            entities=entities,
-            reply_markup=get_mailing_confirmation_keyboard()
+async def send_mailing_preview(bot: Bot, chat_id: int, data: dict):
+    """Копирует черновик админу так же, как он уйдет получателям"""
+    message_ids = data['message_ids']
+    if len(message_ids) > 1:
+        await bot.copy_messages(chat_id=chat_id, from_chat_id=data['from_chat_id'], message_ids=message_ids)
+        await bot.send_message(
+            chat_id,
+            f"👆 Альбом из {len(message_ids)} элементов. Кнопки к альбому прикрепить нельзя.\n"
+            f"Проверьте, что все элементы на месте.",
+            reply_markup=get_mailing_confirmation_keyboard(allow_buttons=False)
         )
-        
-    elif message.content_type == ContentType.PHOTO:
-        photo = message.photo[-1].file_id
-        caption = message.caption or ""
-        caption_entities = message.caption_entities
-        
-        await state.update_data({
-            'content_type': ContentType.PHOTO,
-            'photo': photo,
-            'caption': caption,
-            'caption_entities': caption_entities,
-            'buttons': []
-        })
-        
-        await message.answer_photo(
-            photo=photo,
-            caption=caption,
-            caption_entities=caption_entities,
-            reply_markup=get_mailing_confirmation_keyboard()
-        )
-        
     else:
+        await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=data['from_chat_id'],
+            message_id=message_ids[0],
+            reply_markup=get_mailing_confirmation_keyboard(data.get('buttons'))
+        )
+
+# Ключи FSM-данных с частями собираемого альбома: album_part:<message_id>
+ALBUM_PART_PREFIX = 'album_part:'
+
+def get_album_parts(data: dict, media_group_id: str) -> dict:
+    """message_id -> время прихода для частей альбома media_group_id"""
+    return {
+        int(key[len(ALBUM_PART_PREFIX):]): part['at']
+        for key, part in data.items()
+        if key.startswith(ALBUM_PART_PREFIX) and part['group'] == media_group_id
+    }
+
+async def collect_album(message: Message, state: FSMContext):
+    """Собирает альбом в FSM; список message_id - у части, которая его завершила, иначе None.
+
+    Части приходят отдельными апдейтами и при webhook или общем FSM могут попасть
+    в разные процессы. Каждая часть пишет свой ключ (слияние данных атомарно, записи
+    не теряются), а альбом завершает часть, после которой MAILING_ALBUM_DELAY
+    не приходило новых.
+    """
+    await state.update_data({
+        f'{ALBUM_PART_PREFIX}{message.message_id}': {'group': message.media_group_id, 'at': time.time()}
+    })
+    await asyncio.sleep(MAILING_ALBUM_DELAY)
+    # update_data без изменений читает запись из хранилища в обход локального кэша
+    data = await state.update_data({})
+    if await state.get_state() != MailingStates.waiting_for_content.state:
+        return None
+    parts = get_album_parts(data, message.media_group_id)
+    latest = max(parts.items(), key=lambda item: (item[1], item[0]))[0]
+    if latest != message.message_id:
+        return None
+    await state.set_data({key: value for key, value in data.items() if not key.startswith(ALBUM_PART_PREFIX)})
+    return sorted(parts)
+
+async def process_late_album_part(message: Message, state: FSMContext):
+    """Часть альбома, пришедшая после того, как черновик уже собран"""
+    data = await state.get_data()
+    if data.get('media_group_id') != message.media_group_id:
+        return
+    logger.warning("Часть альбома пришла после сборки черновика", extra={'user_id': message.from_user.id})
+    await message.answer(
+        f"⚠️ Часть альбома пришла с опозданием и не вошла в черновик "
+        f"(в нем {len(data.get('message_ids') or [])} элем.).\n"
+        f"Если альбом неполный, начните заново: /mailing"
+    )
+
+async def process_mailing_content(message: Message, state: FSMContext):
+    if message.content_type not in MAILING_CONTENT_TYPES:
         await message.answer(
-            "❌ Поддерживаются только текстовые сообщения или фото с подписью.\n"
+            "❌ Поддерживаются текст, фото, видео, документы, GIF, аудио, голосовые сообщения и альбомы.\n"
             "Попробуйте еще раз."
         )
         return
     
+    if message.media_group_id:
+        message_ids = await collect_album(message, state)
+        if message_ids is None:
+            return
+    else:
+        message_ids = [message.message_id]
+    
+    # Рассылка копирует исходное сообщение (copyMessage): файлы не загружаются
+    # заново, а запрос на получателя одинаково мал для любого типа контента
+    data = {
+        'content_type': message.content_type,
+        'from_chat_id': message.chat.id,
+        'message_ids': message_ids,
+        'media_group_id': message.media_group_id,
+        'buttons': []
+    }
+    await state.update_data(data)
+    await send_mailing_preview(message.bot, message.chat.id, data)
     await state.set_state(MailingStates.preview_sent)
 
-async def send_mailing_to_all_users(callback: CallbackQuery, state: FSMContext, bot: Bot, get_all_user_ids_func):
-    data = await state.get_data()
-    content_type = data.get('content_type')
-    buttons = data.get('buttons', [])
+async def send_mailing_message(bot: Bot, user_id: int, data: dict, reply_markup=None):
+    message_ids = data.get('message_ids')
+    if message_ids and len(message_ids) > 1:
+        await bot.copy_messages(chat_id=user_id, from_chat_id=data['from_chat_id'], message_ids=message_ids)
+    elif message_ids:
+        await bot.copy_message(
+            chat_id=user_id,
+            from_chat_id=data['from_chat_id'],
+            message_id=message_ids[0],
+            reply_markup=reply_markup
+        )
+    # Задания, созданные до перехода на copyMessage, хранят содержимое целиком
+    elif data.get('content_type') == ContentType.TEXT:
+        await bot.send_message(
+            chat_id=user_id,
+            text=data.get('text'),
+            entities=data.get('entities'),
+            reply_markup=reply_markup
+        )
+    elif data.get('content_type') == ContentType.PHOTO:
+        await bot.send_photo(
+            chat_id=user_id,
+            photo=data.get('photo'),
+            caption=data.get('caption'),
+            caption_entities=data.get('caption_entities'),
+            reply_markup=reply_markup
+        )
+
+async def wait_for_token(bucket: TokenBucket, stop_event: asyncio.Event = None) -> bool:
+    """Ждет токен; False, если раньше сработал stop_event (при медленном темпе ждать можно долго)"""
+    if stop_event is None:
+        await bucket.acquire()
+        return True
+    if stop_event.is_set():
+        return False
+    acquire = asyncio.create_task(bucket.acquire())
+    stop = asyncio.create_task(stop_event.wait())
+    done, _ = await asyncio.wait({acquire, stop}, return_when=asyncio.FIRST_COMPLETED)
+    acquire.cancel()
+    stop.cancel()
+    return acquire in done
+
+def delivery_pace(remaining: int, window_end):
+    """Скорость, при которой remaining сообщений равномерно уложатся в окно доставки.
+
+    None - ограничение не нужно: окна нет, оно уже закончилось или общий лимит медленнее.
+    """
+    if not window_end or not remaining:
+        return None
+    seconds_left = (window_end - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    if seconds_left <= 0:
+        return None
+    rate = remaining / seconds_left
+    return rate if rate < MAILING_RATE_LIMIT else None
+
+async def refresh_delivery_pace(pacer: TokenBucket, progress: BroadcastProgress, window_end,
+                                interval: float = DELIVERY_PACE_REFRESH):
+    """Пересчитывает темп окна по оставшимся получателям: после повторов, пауз по 429
+    и уступок планировщику рассылка иначе не успевает к концу окна"""
+    while True:
+        await asyncio.sleep(interval)
+        pacer.set_rate(delivery_pace(progress.remaining, window_end) or MAILING_RATE_LIMIT)
+
+async def run_broadcast(bot: Bot, data: dict, reply_markup, audience, total_users: int,
+                        limiter: TokenBucket = None, workers: int = MAILING_WORKERS,
+                        on_result=None, stop_event: asyncio.Event = None,
+                        progress: BroadcastProgress = None, job_id: int = None,
+                        pacer: TokenBucket = None, max_attempts: int = MAILING_RETRY_ATTEMPTS):
+    """Рассылает сообщение пулом воркеров, скорость ограничена общим токен-бакетом.
+
+    audience - асинхронный итератор списков user_id. on_result(user_id, error, attempts)
+    вызывается один раз на получателя с итогом (error=None при успехе). Временные сбои
+    (TRANSIENT_DELIVERY_ERRORS) уходят в очередь повторов с задержкой retry_delay, всего
+    не больше max_attempts попыток; повторы берут токены из того же limiter. После
+    stop_event новые отправки не начинаются, необработанные получатели и ожидающие
+    повтора просто пропускаются. progress обновляется по ходу рассылки. pacer
+    дополнительно ограничивает скорость подачи получателей (окно доставки).
+    Если on_result падает (например, чекпоинт не записался в БД), рассылка
+    останавливается через stop_event, а ошибка пробрасывается после остановки воркеров.
+    Возвращает (успешно, ошибок) за этот запуск.
+    """
+    limiter = limiter or mailing_limiter
+    stop_event = stop_event or asyncio.Event()
+    result_errors = []
+    queue = asyncio.Queue(maxsize=workers * 2)
+    counters = {'success': 0, 'error': 0}
+    progress = progress or BroadcastProgress(total_users)
+    # (время повтора, user_id, номер попытки)
+    retries = []
+    retry_added = asyncio.Event()
+    # Получатели, по которым еще нет итога (в очереди, в отправке или ждут повтора)
+    unsettled = 0
+    audience_done = False
+    all_settled = asyncio.Event()
     
-    if not content_type:
-        await callback.answer("❌ Данные рассылки не найдены", show_alert=True)
-        return
+    def settle():
+        nonlocal unsettled
+        unsettled -= 1
+        if audience_done and not unsettled:
+            all_settled.set()
     
-    user_ids = await get_all_user_ids_func()
+    async def deliver(user_id: int):
+        for _ in range(MAILING_MAX_RETRY_AFTER):
+            await limiter.acquire()
+            try:
+                await send_mailing_message(bot, user_id, data, reply_markup)
+                return
+            except TelegramRetryAfter as e:
+                # 429 относится ко всему боту: останавливаем весь бакет
+                logger.warning("⏸ Лимит Telegram, пауза %sс", e.retry_after, extra={'job_id': job_id})
+                limiter.pause(e.retry_after)
+        raise RetryAfterExhausted(f"превышено число повторов после retry_after ({MAILING_MAX_RETRY_AFTER})")
     
-    if not user_ids:
-        await callback.answer("❌ Нет пользователей для рассылки", show_alert=True)
-        return
+    async def pump_retries():
+        # Возвращает в очередь получателей, у которых подошло время повтора
+        while True:
+            retry_added.clear()
+            delay = retries[0][0] - time.monotonic() if retries else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(retry_added.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, user_id, attempt = heapq.heappop(retries)
+            progress.retrying -= 1
+            await queue.put((user_id, attempt))
     
-    if callback.message.text:
-        await callback.message.edit_text("📤 **ОТПРАВКА РАССЫЛКИ...**\n\nПожалуйста, подождите...")
-    else:
-        await callback.message.answer("📤 **ОТПРАВКА РАССЫЛКИ...**\n\nПожалуйста, подождите...")
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            user_id, attempt = item
+            if stop_event.is_set():
+                settle()
+                continue
+            log_extra = {'user_id': user_id, 'job_id': job_id}
+            error_msg = None
+            delivery_status = None
+            try:
+                await deliver(user_id)
+            except TRANSIENT_DELIVERY_ERRORS as e:
+                if attempt < max_attempts:
+                    delay = retry_delay(attempt)
+                    logger.debug("🔁 Временная ошибка (попытка %d), повтор через %.1fс: %s", attempt, delay, e,
+                                 extra={**log_extra, 'error_class': type(e).__name__})
+                    heapq.heappush(retries, (time.monotonic() + delay, user_id, attempt + 1))
+                    progress.retrying += 1
+                    retry_added.set()
+                    metrics.BROADCAST_MESSAGES.inc('retry')
+                    continue
+                error_msg = str(e) or type(e).__name__
+                logger.warning("❌ [%d/%d] Ошибка отправки после %d попыток: %s", progress.done + 1, total_users,
+                               attempt, e, extra={**log_extra, 'error_class': type(e).__name__})
+            except Exception as e:
+                error_msg = str(e)
+                delivery_status = classify_delivery_error(error_msg)
+                if delivery_status:
+                    logger.debug("❌ [%d/%d] Пользователь недоступен: %s", progress.done + 1, total_users,
+                                 delivery_status, extra=log_extra)
+                else:
+                    logger.warning("❌ [%d/%d] Ошибка отправки: %s", progress.done + 1, total_users, e,
+                                   extra={**log_extra, 'error_class': type(e).__name__})
+            
+            if error_msg is None:
+                counters['success'] += 1
+                progress.sent += 1
+                if attempt > 1:
+                    progress.retried += 1
+                metrics.BROADCAST_MESSAGES.inc('sent')
+                logger.debug("✅ [%d/%d] Сообщение отправлено", progress.done, total_users,
+                             extra={**log_extra, 'sampled': True})
+            else:
+                counters['error'] += 1
+                progress.failed += 1
+                metrics.BROADCAST_MESSAGES.inc(delivery_status or 'failed')
+            try:
+                if on_result:
+                    await on_result(user_id, error_msg, attempt)
+            except Exception as e:
+                # Воркер не должен умирать: иначе подача получателей зависнет на полной
+                # очереди и задание нельзя будет ни остановить, ни отменить
+                if not result_errors:
+                    logger.exception("Не удалось сохранить результат доставки, останавливаем рассылку",
+                                     extra={**log_extra, 'error_class': type(e).__name__})
+                result_errors.append(e)
+                stop_event.set()
+            finally:
+                settle()
     
-    success_count = 0
-    error_count = 0
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    pump = asyncio.create_task(pump_retries())
+    try:
+        async for user_ids in audience:
+            if stop_event.is_set():
+                break
+            for user_id in user_ids:
+                if pacer and not await wait_for_token(pacer, stop_event):
+                    break
+                unsettled += 1
+                await queue.put((user_id, 1))
+        audience_done = True
+        if not unsettled:
+            all_settled.set()
+        # Ждем итога по всем, включая повторы; по stop_event ожидающие повтора отбрасываются
+        waiters = [asyncio.create_task(all_settled.wait()), asyncio.create_task(stop_event.wait())]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        pump.cancel()
+        retries.clear()
+        progress.retrying = 0
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        pump.cancel()
+        for task in tasks:
+            task.cancel()
     
+    if result_errors:
+        raise result_errors[0]
+    return counters['success'], counters['error']
+
+def build_reply_markup(buttons):
     keyboard = []
     if buttons:
         for button in buttons:
             keyboard.append([InlineKeyboardButton(text=button['text'], url=button['url'])])
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard) if keyboard else None
-    
-    print(f"[MAILING] Начинаем рассылку для {len(user_ids)} пользователей")
-    for i, user_id in enumerate(user_ids, 1):
+    return InlineKeyboardMarkup(inline_keyboard=keyboard) if keyboard else None
+
+def dump_mailing_payload(data: dict) -> dict:
+    """Готовит данные черновика к сохранению в JSONB"""
+    payload = {key: data.get(key) for key in ('content_type', 'from_chat_id', 'message_ids')}
+    payload['buttons'] = data.get('buttons', [])
+    # Получатели уже зафиксированы в broadcast_recipients, сам список ID не нужен
+    segment = dict(data.get('segment') or {})
+    if 'user_ids' in segment:
+        segment['user_ids_count'] = len(segment.pop('user_ids'))
+    payload['segment'] = segment
+    return payload
+
+def load_mailing_payload(payload: dict) -> dict:
+    data = dict(payload)
+    for key in ('entities', 'caption_entities'):
+        if data.get(key):
+            data[key] = [MessageEntity(**entity) for entity in data[key]]
+    return data
+
+def get_job_control_keyboard(job_id: int, paused: bool = False, scheduled: bool = False):
+    if scheduled:
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="❌ Отменить", callback_data=f"job:cancel:{job_id}")
+        ]])
+    if paused:
+        first = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"job:resume:{job_id}")
+    else:
+        first = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"job:pause:{job_id}")
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        first,
+        InlineKeyboardButton(text="❌ Отменить", callback_data=f"job:cancel:{job_id}")
+    ]])
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+def format_local_time(value) -> str:
+    return value.astimezone(MAILING_TIMEZONE).strftime('%d.%m.%Y %H:%M')
+
+def format_job_schedule(job) -> str:
+    lines = []
+    if job['status'] == 'scheduled' and job['start_at']:
+        lines.append(f"🚀 Старт: {format_local_time(job['start_at'])}")
+    if job['window_end'] and job['status'] in ('scheduled', 'running', 'paused'):
+        lines.append(f"⏱ Доставка до: {format_local_time(job['window_end'])}")
+    return "".join(f"\n{line}" for line in lines)
+
+def format_job_status(job, progress: BroadcastProgress = None) -> str:
+    titles = {
+        'running': "📤 **ОТПРАВКА РАССЫЛКИ...**",
+        'paused': "⏸ **РАССЫЛКА ПРИОСТАНОВЛЕНА**",
+        'cancelled': "❌ **РАССЫЛКА ОТМЕНЕНА**",
+        'done': "✅ **РАССЫЛКА ЗАВЕРШЕНА!**",
+        'scheduled': "🕒 **РАССЫЛКА ЗАПЛАНИРОВАНА**"
+    }
+    schedule = format_job_schedule(job)
+    retried = f"♻️ Доставлено после повтора: {job['retried']}\n" if job['retried'] else ""
+    pending = job['total'] - job['sent'] - job['failed']
+    pending = f"⏳ Не обработано: {pending}\n" if pending > 0 and job['status'] != 'scheduled' else ""
+    if progress:
+        eta = progress.eta
+        return (
+            f"{titles['running']}\n\n"
+            f"🆔 Задание #{job['id']}\n"
+            f"✅ Успешно отправлено: {progress.sent}\n"
+            f"❌ Ошибок: {progress.failed}\n"
+            f"⏳ Осталось: {progress.remaining}\n"
+            f"🔁 Ждут повтора: {progress.retrying}\n"
+            f"♻️ Доставлено после повтора: {progress.retried}\n"
+            f"⚡ Скорость: {progress.rate:.1f} сообщ./с\n"
+            f"🕒 Примерно до конца: {format_duration(eta) if eta is not None else '—'}\n"
+            f"📈 Всего пользователей: {progress.total}"
+            f"{schedule}"
+        )
+    return (
+        f"{titles.get(job['status'], job['status'])}\n\n"
+        f"🆔 Задание #{job['id']}\n"
+        f"✅ Успешно отправлено: {job['sent']}\n"
+        f"❌ Ошибок: {job['failed']}\n"
+        f"{retried}{pending}"
+        f"📈 Всего пользователей: {job['total']}"
+        f"{schedule}"
+    )
+
+async def edit_progress_message(bot: Bot, job, progress: BroadcastProgress):
+    # Редактирование тоже тратит лимит API, берем токен из общего бакета
+    await mailing_limiter.acquire()
+    try:
+        await bot.edit_message_text(
+            format_job_status(job, progress),
+            chat_id=job['status_chat_id'],
+            message_id=job['status_message_id'],
+            reply_markup=get_job_control_keyboard(job['id'])
+        )
+    except Exception as e:
+        logger.warning("Не удалось обновить прогресс задания: %s", e, extra={'job_id': job['id']})
+
+async def report_progress(bot: Bot, job, progress: BroadcastProgress, interval: float = MAILING_PROGRESS_INTERVAL):
+    """Периодически редактирует сообщение статуса; работает до отмены задачи"""
+    last_done = None
+    while True:
+        await asyncio.sleep(interval)
+        if progress.done == last_done:
+            continue
+        last_done = progress.done
+        progress.tick()
+        await edit_progress_message(bot, job, progress)
+
+async def show_job_status(bot: Bot, job):
+    if not job['status_chat_id']:
+        return
+    reply_markup = None
+    if job['status'] in ('running', 'paused', 'scheduled'):
+        reply_markup = get_job_control_keyboard(
+            job['id'], paused=job['status'] == 'paused', scheduled=job['status'] == 'scheduled'
+        )
+    try:
+        await bot.edit_message_text(
+            format_job_status(job),
+            chat_id=job['status_chat_id'],
+            message_id=job['status_message_id'],
+            reply_markup=reply_markup
+        )
+    except Exception as e:
+        logger.warning("Не удалось обновить статус задания: %s", e, extra={'job_id': job['id']})
+
+class JobCheckpoint:
+    """Копит результаты доставки и пакетно пишет их в broadcast_recipients.
+
+    Если при записи выясняется, что задание больше не running (пауза или отмена,
+    в том числе из другого процесса), выставляет stop_event.
+    """
+
+    def __init__(self, job_id: int, stop_event: asyncio.Event, batch_size: int = MAILING_CHECKPOINT_BATCH):
+        self.job_id = job_id
+        self.stop_event = stop_event
+        self.batch_size = batch_size
+        self._results = []
+        self._lock = asyncio.Lock()
+
+    async def record(self, user_id: int, error: str = None, attempts: int = 1):
+        self._results.append((user_id, error, attempts))
+        if len(self._results) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._results:
+                return
+            # Пакет убирается из буфера только после успешной записи: при ошибке БД
+            # он будет записан следующим flush (запись идемпотентна)
+            batch = self._results[:]
+            failures = []
+            for user_id, error, _ in batch:
+                delivery_status = classify_delivery_error(error) if error else None
+                if delivery_status:
+                    failures.append((user_id, delivery_status))
+            await database.mark_users_undeliverable(failures)
+            status = await database.save_broadcast_results(self.job_id, batch)
+            # record() мог дописать результаты во время записи - они остаются в конце
+            del self._results[:len(batch)]
+        if status != 'running':
+            self.stop_event.set()
+
+async def run_broadcast_job(bot: Bot, job_id: int, stop_event: asyncio.Event):
+    owner = None
+    try:
+        # Несколько экземпляров бота не должны рассылать одно задание одновременно
+        owner = await database.lock_broadcast_job(job_id)
+        if not owner:
+            logger.info("Задание уже рассылает другой процесс, пропускаем", extra={'job_id': job_id})
+            return
+        job = await database.get_broadcast_job(job_id)
+        data = load_mailing_payload(job['payload'])
+        checkpoint = JobCheckpoint(job_id, stop_event)
+        progress = BroadcastProgress(job['total'], job['sent'], job['failed'], job['retried'])
+        _job_progress[job_id] = progress
+        
+        pace = delivery_pace(progress.remaining, job['window_end'])
+        pacer = None
+        pacer_refresh = None
+        if job['window_end']:
+            pacer = TokenBucket(pace or MAILING_RATE_LIMIT, capacity=1)
+            pacer_refresh = asyncio.create_task(refresh_delivery_pace(pacer, progress, job['window_end']))
+        logger.info("Начинаем рассылку для %d пользователей%s", progress.remaining,
+                    f" (темп {pace:.2f} сообщ./с)" if pace else "", extra={'job_id': job_id})
+        reporter = None
+        if job['status_chat_id']:
+            reporter = asyncio.create_task(report_progress(bot, job, progress))
         try:
-            if content_type == ContentType.TEXT:
-                text = data.get('text')
-                entities = data.get('entities')
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=text,
-                    entities=entities,
-                    reply_markup=reply_markup
-                )
-                print(f"[MAILING] ✅ [{i}/{len(user_ids)}] Текст отправлен пользователю {user_id}")
-                
-            elif content_type == ContentType.PHOTO:
-                photo = data.get('photo')
-                caption = data.get('caption')
-                caption_entities = data.get('caption_entities')
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=photo,
-                    caption=caption,
-                    caption_entities=caption_entities,
-                    reply_markup=reply_markup
-                )
-                print(f"[MAILING] ✅ [{i}/{len(user_ids)}] Фото отправлено пользователю {user_id}")
-            
-            success_count += 1
-            
-            await asyncio.sleep(0.05)
-            
-        except Exception as e:
-            error_count += 1
-            error_msg = str(e)
-            
-            # Определяем тип ошибки для более информативного лога
-            if "bot was blocked by the user" in error_msg:
-                print(f"[MAILING] ❌ [{i}/{len(user_ids)}] Пользователь {user_id} заблокировал бота")
-            elif "bot can't initiate conversation with a user" in error_msg:
-                print(f"[MAILING] ❌ [{i}/{len(user_ids)}] Пользователь {user_id} не инициировал диалог с ботом (никогда не писал /start)")
-            elif "user is deactivated" in error_msg:
-                print(f"[MAILING] ❌ [{i}/{len(user_ids)}] Пользователь {user_id} деактивирован")
-            else:
-                print(f"[MAILING] ❌ [{i}/{len(user_ids)}] Ошибка отправки пользователю {user_id}: {e}")
-    
-    result_text = (
-        f"✅ **РАССЫЛКА ЗАВЕРШЕНА!**\n\n"
-        f"📊 **Статистика:**\n"
-        f"✅ Успешно отправлено: {success_count}\n"
-        f"❌ Ошибок: {error_count}\n"
-        f"📈 Всего пользователей: {len(user_ids)}"
+            await run_broadcast(
+                bot, data, build_reply_markup(data.get('buttons')),
+                database.iter_broadcast_recipients(job_id), progress.total,
+                on_result=checkpoint.record, stop_event=stop_event, progress=progress,
+                job_id=job_id, pacer=pacer
+            )
+        finally:
+            if reporter:
+                reporter.cancel()
+            if pacer_refresh:
+                pacer_refresh.cancel()
+        await checkpoint.flush()
+        job = await database.finish_broadcast_job(job_id)
+    except Exception as e:
+        # Задание остается running и будет продолжено при следующем запуске
+        logger.exception("Задание прервано", extra={'job_id': job_id, 'error_class': type(e).__name__})
+        return
+    finally:
+        if owner:
+            await owner.close()
+        _job_runners.pop(job_id, None)
+        _job_progress.pop(job_id, None)
+    
+    if job['status'] == 'running' and stop_event.is_set():
+        # Рассылку продолжили, пока воркеры останавливались после паузы
+        start_broadcast_job(bot, job_id)
+        return
+    
+    logger.info("🎯 Задание %s. Успешно: %d, Ошибок: %d, Всего: %d",
+                job['status'], job['sent'], job['failed'], job['total'], extra={'job_id': job_id})
+    await show_job_status(bot, job)
+
+async def watch_broadcast_job(bot: Bot, job_id: int, stop_event: asyncio.Event,
+                              interval: float = MAILING_PROGRESS_INTERVAL):
+    """Следит за заданием, которое рассылают процессы broadcast_worker.py.
+
+    Прогресс читается из broadcast_jobs (воркеры пишут его чекпоинтами), задание
+    закрывается, когда не остается ни pending, ни забранных получателей.
+    """
+    try:
+        job = await database.get_broadcast_job(job_id)
+        progress = BroadcastProgress(job['total'], job['sent'], job['failed'], job['retried'])
+        _job_progress[job_id] = progress
+        last_done = progress.done
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            job = await database.finish_broadcast_job(job_id)
+            progress.sent, progress.failed, progress.retried = job['sent'], job['failed'], job['retried']
+            if job['status'] != 'running':
+                break
+            if job['status_chat_id'] and progress.done != last_done:
+                last_done = progress.done
+                progress.tick()
+                await edit_progress_message(bot, job, progress)
+        if stop_event.is_set():
+            job = await database.get_broadcast_job(job_id)
+    except Exception as e:
+        logger.exception("Ошибка наблюдения за заданием", extra={'job_id': job_id, 'error_class': type(e).__name__})
+        return
+    finally:
+        _job_runners.pop(job_id, None)
+        _job_progress.pop(job_id, None)
+    
+    if job['status'] == 'running':
+        # Рассылку продолжили, пока наблюдатель останавливался после паузы
+        start_broadcast_job(bot, job_id)
+        return
+    
+    logger.info("🎯 Задание %s. Успешно: %d, Ошибок: %d, Всего: %d",
+                job['status'], job['sent'], job['failed'], job['total'], extra={'job_id': job_id})
+    await show_job_status(bot, job)
+
+def start_broadcast_job(bot: Bot, job_id: int):
+    if job_id in _job_runners:
+        return
+    stop_event = asyncio.Event()
+    runner = watch_broadcast_job if MAILING_EXECUTOR == 'workers' else run_broadcast_job
+    task = asyncio.create_task(runner(bot, job_id, stop_event))
+    _job_runners[job_id] = (task, stop_event)
+
+async def resume_broadcast_jobs(bot: Bot):
+    """Продолжает задания, прерванные перезапуском, с последнего чекпоинта"""
+    for job in await database.get_unfinished_broadcast_jobs():
+        if job['status'] == 'running':
+            logger.info("Возобновляем задание (%d/%d)", job['sent'] + job['failed'], job['total'],
+                        extra={'job_id': job['id']})
+            start_broadcast_job(bot, job['id'])
+
+def describe_segment(segment: dict) -> str:
+    segment = segment or {}
+    date_from = segment.get('date_from')
+    date_to = segment.get('date_to')
+    if date_from or date_to:
+        period = f"{format_iso_date(date_from) or '…'} — {format_iso_date(date_to) or '…'}"
+    else:
+        period = "за все время"
+    user_ids = segment.get('user_ids')
+    return (
+        f"📅 Регистрация: {period}\n"
+        f"👤 Только с username: {'да' if segment.get('has_username') else 'нет'}\n"
+        f"🚪 Источник: {SEGMENT_SOURCE_TITLES.get(segment.get('source'), segment.get('source'))}\n"
+        f"✅ Только доступные: {'да' if segment.get('reachable_only', True) else 'нет'}\n"
+        f"📄 Список ID: {len(user_ids) if user_ids is not None else 'не задан'}"
+    )
+
+def format_iso_date(value):
+    return datetime.date.fromisoformat(value).strftime('%d.%m.%Y') if value else None
+
+def parse_date_range(text: str):
+    """'01.09.2025-30.09.2025', '01.09.2025-', '-30.09.2025' или один день -> (date_from, date_to) в ISO"""
+    parts = text.replace(' ', '').split('-')
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2 or not any(parts):
+        raise ValueError(text)
+    date_from, date_to = (
+        datetime.datetime.strptime(part, '%d.%m.%Y').date().isoformat() if part else None
+        for part in parts
     )
+    if date_from and date_to and date_from > date_to:
+        raise ValueError(text)
+    return date_from, date_to
+
+def parse_user_ids(content: bytes):
+    """Все целые числа из текста или файла (по одному на строку, через запятую и т.п.).
+
+    Числа вне диапазона ID пользователя (положительный bigint) отбрасываются.
+    """
+    user_ids = set()
+    for value in re.findall(rb'-?\d+', content):
+        # Длинные строки цифр не переводим в int целиком
+        if len(value) > len(str(database.BIGINT_MAX)):
+            continue
+        user_id = int(value)
+        if 0 < user_id <= database.BIGINT_MAX:
+            user_ids.add(user_id)
+    return sorted(user_ids)
+
+def get_segment_keyboard(segment: dict):
+    segment = segment or {}
+    source = segment.get('source')
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📅 Период регистрации", callback_data="segment:dates")],
+        [InlineKeyboardButton(
+            text=f"👤 С username: {'да' if segment.get('has_username') else 'нет'}",
+            callback_data="segment:username"
+        )],
+        [InlineKeyboardButton(
+            text=f"🚪 Источник: {SEGMENT_SOURCE_TITLES.get(source, source)}",
+            callback_data="segment:source"
+        )],
+        [InlineKeyboardButton(
+            text=f"✅ Только доступные: {'да' if segment.get('reachable_only', True) else 'нет'}",
+            callback_data="segment:reachable"
+        )],
+        [InlineKeyboardButton(text="📄 Загрузить список ID", callback_data="segment:ids")],
+        [
+            InlineKeyboardButton(text="♻️ Сбросить", callback_data="segment:reset"),
+            InlineKeyboardButton(text="➡️ Готово", callback_data="mailing:confirm_send")
+        ]
+    ])
+
+async def show_segment_menu(message: Message, state: FSMContext, edit: bool = False):
+    data = await state.get_data()
+    segment = data.get('segment') or {}
+    count = await database.count_audience(segment)
+    text = (
+        f"🎯 **АУДИТОРИЯ РАССЫЛКИ**\n\n"
+        f"{describe_segment(segment)}\n\n"
+        f"👥 Получателей: {count}"
+    )
+    if edit and message.text:
+        await message.edit_text(text, reply_markup=get_segment_keyboard(segment), parse_mode="Markdown")
+    else:
+        await message.answer(text, reply_markup=get_segment_keyboard(segment), parse_mode="Markdown")
+    await state.set_state(MailingStates.preview_sent)
+
+async def update_segment(callback: CallbackQuery, state: FSMContext):
+    action = callback.data.split(':')[1]
+    data = await state.get_data()
+    segment = dict(data.get('segment') or {})
     
-    print(f"[MAILING] 🎯 РАССЫЛКА ЗАВЕРШЕНА! Успешно: {success_count}, Ошибок: {error_count}, Всего: {len(user_ids)}")
+    if action == "username":
+        segment['has_username'] = not segment.get('has_username')
+    elif action == "source":
+        sources = list(SEGMENT_SOURCE_TITLES)
+        segment['source'] = sources[(sources.index(segment.get('source')) + 1) % len(sources)]
+    elif action == "reachable":
+        segment['reachable_only'] = not segment.get('reachable_only', True)
+    elif action == "reset":
+        segment = {}
+    elif action == "dates":
+        await callback.message.answer(
+            "📅 Отправьте период регистрации в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.\n"
+            "Одну из дат можно не указывать: 01.09.2025- или -30.09.2025.\n"
+            "Отправьте 0, чтобы убрать ограничение по дате."
+        )
+        await state.set_state(MailingStates.waiting_for_segment_dates)
+        await callback.answer()
+        return
+    elif action == "ids":
+        await callback.message.answer(
+            f"📄 Отправьте файл .txt/.csv или сообщение со списком ID пользователей "
+            f"(до {MAILING_SEGMENT_MAX_IDS}).\n"
+            "Отправьте 0, чтобы убрать список."
+        )
+        await state.set_state(MailingStates.waiting_for_segment_ids)
+        await callback.answer()
+        return
     
-    if callback.message.text:
-        await callback.message.edit_text(result_text)
+    await state.update_data(segment=segment)
+    await callback.answer()
+    await show_segment_menu(callback.message, state, edit=True)
+
+async def process_segment_dates(message: Message, state: FSMContext):
+    data = await state.get_data()
+    segment = dict(data.get('segment') or {})
+    text = (message.text or '').strip()
+    if text == '0':
+        segment.pop('date_from', None)
+        segment.pop('date_to', None)
+    else:
+        try:
+            segment['date_from'], segment['date_to'] = parse_date_range(text)
+        except ValueError:
+            await message.answer("❌ Неверный формат. Пример: 01.09.2025-30.09.2025")
+            return
+    await state.update_data(segment=segment)
+    await show_segment_menu(message, state)
+
+async def process_segment_ids(message: Message, state: FSMContext):
+    data = await state.get_data()
+    segment = dict(data.get('segment') or {})
+    
+    if message.document:
+        if message.document.file_size and message.document.file_size > MAILING_SEGMENT_MAX_FILE_SIZE:
+            await message.answer("❌ Файл слишком большой (максимум 5 МБ)")
+            return
+        content = (await message.bot.download(message.document)).getvalue()
+    elif message.text:
+        content = message.text.encode()
     else:
-        await callback.message.answer(result_text)
+        await message.answer("❌ Отправьте файл или сообщение со списком ID")
+        return
+    
+    if content.strip() == b'0':
+        segment.pop('user_ids', None)
+    else:
+        user_ids = parse_user_ids(content)
+        if not user_ids:
+            await message.answer("❌ В сообщении не найдено ни одного ID")
+            return
+        if len(user_ids) > MAILING_SEGMENT_MAX_IDS:
+            await message.answer(f"❌ Слишком много ID: {len(user_ids)} (максимум {MAILING_SEGMENT_MAX_IDS})")
+            return
+        segment['user_ids'] = user_ids
+    await state.update_data(segment=segment)
+    await show_segment_menu(message, state)
+
+async def show_send_confirmation(callback: CallbackQuery, state: FSMContext):
+    """Точное число получателей сегмента перед запуском рассылки"""
+    data = await state.get_data()
+    if not data.get('content_type'):
+        await callback.answer("❌ Данные рассылки не найдены", show_alert=True)
+        return
+    segment = data.get('segment') or {}
+    count = await database.count_audience(segment)
+    await callback.answer()
+    await callback.message.answer(
+        f"📨 **ЗАПУСК РАССЫЛКИ**\n\n"
+        f"{describe_segment(segment)}\n\n"
+        f"👥 Получателей: {count}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="🚀 Запустить", callback_data="mailing:launch"),
+                InlineKeyboardButton(text="🕒 Запланировать", callback_data="mailing:schedule")
+            ],
+            [
+                InlineKeyboardButton(text="🎯 Аудитория", callback_data="mailing:segment"),
+                InlineKeyboardButton(text="❌ Отменить", callback_data="mailing:confirm_cancel")
+            ]
+        ]),
+        parse_mode="Markdown"
+    )
+
+async def create_job_from_draft(state: FSMContext, admin_id: int, start_at=None, window_end=None):
+    """Создает задание из черновика; возвращает (задание, текст ошибки)"""
+    data = await state.get_data()
+    if not data.get('content_type'):
+        return None, "❌ Данные рассылки не найдены"
+    
+    job = await database.create_broadcast_job(
+        admin_id, dump_mailing_payload(data), data.get('segment'), start_at, window_end
+    )
+    if not job['total']:
+        await database.set_broadcast_job_status(job['id'], 'cancelled', ('running', 'scheduled'))
+        return None, "❌ В выбранной аудитории нет пользователей"
     
     await state.clear()
+    return job, None
+
+async def post_job_status(bot: Bot, job, message: Message, edit: bool = False):
+    """Отправляет сообщение статуса задания и запускает его, если старт не отложен"""
+    status_text = format_job_status(job)
+    reply_markup = get_job_control_keyboard(job['id'], scheduled=job['status'] == 'scheduled')
+    if edit and message.text:
+        status_message = await message.edit_text(status_text, reply_markup=reply_markup)
+    else:
+        status_message = await message.answer(status_text, reply_markup=reply_markup)
+    await database.set_broadcast_job_message(job['id'], status_message.chat.id, status_message.message_id)
+    
+    if job['status'] == 'running':
+        start_broadcast_job(bot, job['id'])
+
+async def send_mailing_to_all_users(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    job, error = await create_job_from_draft(state, callback.from_user.id)
+    if error:
+        await callback.answer(error, show_alert=True)
+        return
+    await callback.answer()
+    await post_job_status(bot, job, callback.message, edit=True)
+
+def parse_schedule(text: str, now: datetime.datetime = None):
+    """'ДД.ММ.ГГГГ ЧЧ:ММ [часов]' или 'сейчас [часов]' -> (start_at, window_end) в UTC.
+
+    Время задается в MAILING_TIMEZONE; часы - длина окна доставки, без них
+    рассылка идет на полной скорости.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    parts = text.split()
+    if parts and parts[0].lower() == 'сейчас':
+        start_at, rest = now, parts[1:]
+    elif len(parts) >= 2:
+        local = datetime.datetime.strptime(f"{parts[0]} {parts[1]}", '%d.%m.%Y %H:%M')
+        start_at, rest = local.replace(tzinfo=MAILING_TIMEZONE).astimezone(datetime.timezone.utc), parts[2:]
+        if start_at < now - datetime.timedelta(minutes=1):
+            raise ValueError("время уже прошло")
+    else:
+        raise ValueError(text)
+    if len(rest) > 1:
+        raise ValueError(text)
+    window_end = None
+    if rest:
+        hours = float(rest[0].replace(',', '.'))
+        # float() принимает и inf/nan/1e12, на которых timedelta переполняется
+        if not 0 < hours <= MAILING_MAX_WINDOW_HOURS:
+            raise ValueError(text)
+        try:
+            window_end = start_at + datetime.timedelta(hours=hours)
+        except OverflowError:
+            raise ValueError(text)
+    return start_at, window_end
+
+async def ask_schedule(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    await callback.message.answer(
+        "🕒 **ПЛАНИРОВАНИЕ РАССЫЛКИ**\n\n"
+        "Отправьте время старта и, при желании, длину окна доставки в часах:\n"
+        "`18.10.2026 10:00` - старт в 10:00 на полной скорости\n"
+        "`18.10.2026 10:00 3` - отправки равномерно распределятся на 3 часа\n"
+        "`сейчас 2` - начать сразу и растянуть на 2 часа\n\n"
+        f"Часовой пояс: {MAILING_TIMEZONE.key}",
+        parse_mode="Markdown"
+    )
+    await state.set_state(MailingStates.waiting_for_schedule)
+
+async def process_schedule(message: Message, state: FSMContext, bot: Bot):
+    try:
+        start_at, window_end = parse_schedule((message.text or '').strip())
+    except ValueError:
+        await message.answer("❌ Неверный формат. Пример: 18.10.2026 10:00 3")
+        return
+    job, error = await create_job_from_draft(state, message.from_user.id, start_at, window_end)
+    if error:
+        await message.answer(error)
+        await state.clear()
+        return
+    await post_job_status(bot, job, message)
+
+async def control_broadcast_job(callback: CallbackQuery, bot: Bot):
+    _, action, job_id = callback.data.split(':')
+    job_id = int(job_id)
+    
+    if action == "pause":
+        job = await database.set_broadcast_job_status(job_id, 'paused', ('running',))
+    elif action == "resume":
+        job = await database.set_broadcast_job_status(job_id, 'running', ('paused',))
+    elif action == "cancel":
+        job = await database.set_broadcast_job_status(job_id, 'cancelled', ('running', 'paused', 'scheduled'))
+    else:
+        return
+    
+    if not job:
+        await callback.answer("❌ Задание уже завершено или статус изменился", show_alert=True)
+        return
+    
+    runner = _job_runners.get(job_id)
+    if action == "resume":
+        start_broadcast_job(bot, job_id)
+    elif runner:
+        # Воркеры остановятся, итоговый статус покажет сам run_broadcast_job
+        runner[1].set()
+        await callback.answer("⏳ Останавливаем рассылку...")
+        return
+    
+    await callback.answer()
+    await show_job_status(bot, job)
+
+async def list_broadcast_jobs(message: Message):
+    jobs = await database.get_unfinished_broadcast_jobs()
+    if not jobs:
+        await message.answer("📭 Активных рассылок нет")
+        return
+    for job in jobs:
+        await message.answer(
+            format_job_status(job),
+            reply_markup=get_job_control_keyboard(
+                job['id'], paused=job['status'] == 'paused', scheduled=job['status'] == 'scheduled'
+            )
+        )
 
 async def cancel_mailing(callback: CallbackQuery, state: FSMContext):
     if callback.message.text:
@@ -222,30 +1160,11 @@ async def process_button_url(message: Message, state: FSMContext):
     await state.update_data(buttons=buttons)
     await state.update_data(temp_button_text=None)
     
-    content_type = data.get('content_type')
-    
-    if content_type == ContentType.TEXT:
-        text = data.get('text')
-        entities = data.get('entities')
-        await message.answer(
-            text,
-            entities=entities,
-            reply_markup=get_mailing_confirmation_keyboard(buttons)
-        )
-    elif content_type == ContentType.PHOTO:
-        photo = data.get('photo')
-        caption = data.get('caption')
-        caption_entities = data.get('caption_entities')
-        await message.answer_photo(
-            photo=photo,
-            caption=caption,
-            caption_entities=caption_entities,
-            reply_markup=get_mailing_confirmation_keyboard(buttons)
-        )
+    await send_mailing_preview(message.bot, message.chat.id, {**data, 'buttons': buttons})
     
     await state.set_state(MailingStates.preview_sent)
 
-def setup_mailing_handlers(router: Router, bot: Bot, get_all_user_ids_func, is_admin_func=None):
+def setup_mailing_handlers(router: Router, bot: Bot, is_admin_func=None):
     
     @router.message(Command("mailing"))
     async def start_mailing_command(message: Message, state: FSMContext):
@@ -254,9 +1173,11 @@ def setup_mailing_handlers(router: Router, bot: Bot, get_all_user_ids_func, is_a
         
         await message.answer(
             "📧 **СИСТЕМА РАССЫЛКИ**\n\n"
-            "Отправьте сообщение или фото с подписью для рассылки.\n"
+            "Отправьте сообщение для рассылки: текст, фото, видео, документ, GIF, "
+            "аудио, голосовое или альбом.\n"
             "Поддерживается форматирование текста!\n\n"
-            "После отправки вы увидите предварительный просмотр.",
+            "После отправки вы увидите предварительный просмотр. "
+            "Не удаляйте исходное сообщение до конца рассылки - получатели получают его копию.",
             parse_mode="Markdown"
         )
         await state.set_state(MailingStates.waiting_for_content)
@@ -269,6 +1190,12 @@ def setup_mailing_handlers(router: Router, bot: Bot, get_all_user_ids_func, is_a
             return
         await process_mailing_content(message, state)
     
+    @router.message(MailingStates.preview_sent, F.media_group_id)
+    async def handle_late_album_part(message: Message, state: FSMContext):
+        if is_admin_func and not await is_admin_func(message.from_user.id):
+            return
+        await process_late_album_part(message, state)
+    
     @router.callback_query(F.data == "mailing:add_button")
     async def add_button_callback(callback: CallbackQuery, state: FSMContext):
         if is_admin_func and not await is_admin_func(callback.from_user.id):
@@ -299,7 +1226,64 @@ def setup_mailing_handlers(router: Router, bot: Bot, get_all_user_ids_func, is_a
             await callback.answer("❌ У вас нет прав для использования рассылки.", show_alert=True)
             await state.clear()
             return
-        await send_mailing_to_all_users(callback, state, bot, get_all_user_ids_func)
+        await show_send_confirmation(callback, state)
+    
+    @router.callback_query(F.data == "mailing:launch")
+    async def launch_mailing(callback: CallbackQuery, state: FSMContext):
+        if is_admin_func and not await is_admin_func(callback.from_user.id):
+            await callback.answer("❌ У вас нет прав для использования рассылки.", show_alert=True)
+            await state.clear()
+            return
+        await send_mailing_to_all_users(callback, state, bot)
+    
+    @router.callback_query(F.data == "mailing:schedule")
+    async def schedule_mailing(callback: CallbackQuery, state: FSMContext):
+        if is_admin_func and not await is_admin_func(callback.from_user.id):
+            await callback.answer("❌ У вас нет прав для использования рассылки.", show_alert=True)
+            await state.clear()
+            return
+        await ask_schedule(callback, state)
+    
+    @router.message(MailingStates.waiting_for_schedule)
+    async def handle_schedule(message: Message, state: FSMContext):
+        if is_admin_func and not await is_admin_func(message.from_user.id):
+            await message.answer("❌ У вас нет прав для использования рассылки.")
+            await state.clear()
+            return
+        await process_schedule(message, state, bot)
+    
+    @router.callback_query(F.data == "mailing:segment")
+    async def segment_menu_callback(callback: CallbackQuery, state: FSMContext):
+        if is_admin_func and not await is_admin_func(callback.from_user.id):
+            await callback.answer("❌ У вас нет прав для использования рассылки.", show_alert=True)
+            await state.clear()
+            return
+        await callback.answer()
+        await show_segment_menu(callback.message, state)
+    
+    @router.callback_query(F.data.startswith("segment:"))
+    async def segment_callback(callback: CallbackQuery, state: FSMContext):
+        if is_admin_func and not await is_admin_func(callback.from_user.id):
+            await callback.answer("❌ У вас нет прав для использования рассылки.", show_alert=True)
+            await state.clear()
+            return
+        await update_segment(callback, state)
+    
+    @router.message(MailingStates.waiting_for_segment_dates)
+    async def handle_segment_dates(message: Message, state: FSMContext):
+        if is_admin_func and not await is_admin_func(message.from_user.id):
+            await message.answer("❌ У вас нет прав для использования рассылки.")
+            await state.clear()
+            return
+        await process_segment_dates(message, state)
+    
+    @router.message(MailingStates.waiting_for_segment_ids)
+    async def handle_segment_ids(message: Message, state: FSMContext):
+        if is_admin_func and not await is_admin_func(message.from_user.id):
+            await message.answer("❌ У вас нет прав для использования рассылки.")
+            await state.clear()
+            return
+        await process_segment_ids(message, state)
     
     @router.callback_query(F.data == "mailing:confirm_cancel")
     async def cancel_mailing_callback(callback: CallbackQuery, state: FSMContext):
@@ -308,3 +1292,16 @@ def setup_mailing_handlers(router: Router, bot: Bot, get_all_user_ids_func, is_a
             await state.clear()
             return
         await cancel_mailing(callback, state)
+    
+    @router.callback_query(F.data.startswith("job:"))
+    async def job_control_callback(callback: CallbackQuery):
+        if is_admin_func and not await is_admin_func(callback.from_user.id):
+            await callback.answer("❌ У вас нет прав для использования рассылки.", show_alert=True)
+            return
+        await control_broadcast_job(callback, bot)
+    
+    @router.message(Command("jobs"))
+    async def jobs_command(message: Message):
+        if is_admin_func and not await is_admin_func(message.from_user.id):
+            return
+        await list_broadcast_jobs(message)
\ No newline at end of file
@@ -1,16 +1,34 @@
 import asyncio
+import logging
 import os
+from datetime import datetime
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ChatJoinRequest, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.filters import Command
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ChatJoinRequest, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
-from database import init_db, save_user, close_db, get_all_users
-from mailing_system import setup_mailing_handlers
 
+# Модули ниже читают настройки из окружения при импорте
 load_dotenv()
 
+from database import (init_db, save_user, close_db, get_users_page, mark_users_undeliverable, ping, get_pool_stats,
+                      add_join_request, verify_join_requests)
+from mailing_system import setup_mailing_handlers, resume_broadcast_jobs
+from logging_setup import setup_logging, shutdown_logging
+from stats import get_user_statistics, format_user_statistics, start_stats_cache, stop_stats_cache
+from webhook import run_webhook
+from fsm_storage import PostgresStorage
+from join_requests import JoinRequestQueue, JoinRequestApprover
+from scheduler import start_scheduler, stop_scheduler, track_interactive_traffic
+from metrics import instrument_bot, instrument_router, start_metrics_server, JOIN_QUEUE_DEPTH, JOIN_REQUESTS, JOIN_APPROVALS
+from export import export_users_file, export_lock, EXPORT_MAX_FILE_SIZE
+from user_utils import search_users_page, format_user_info, encode_user_cursor, decode_user_cursor
+
+logger = logging.getLogger(__name__)
+
 def decode_env_string(s):
     """Декодирует escape-последовательности из строки .env"""
     if s is None:
@@ -23,39 +41,65 @@ CHANNEL_LINK = os.getenv("CHANNEL_LINK", "https://t.me/+eXOltHvhsk81NTgy")
 RESERVE_LINKS = os.getenv("RESERVE_LINKS")
 TEXT_MESSAGE = decode_env_string(os.getenv("TEXT_MESSAGE")) or "Для доступа в канал необходимо подписаться на наши резервы 👇\n\n"
 RESERVE_LINK_FORMAT = decode_env_string(os.getenv("RESERVE_LINK_FORMAT"))
+# postgres - черновики переживают перезапуск и видны всем процессам, memory - только этот процесс
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+# polling - long polling, webhook - aiohttp-сервер (см. webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Свой сервер Bot API: локальный telegram-bot-api или фейковый из bench/fake_bot_api.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Сколько апдейтов обрабатывается одновременно. При заполнении прием новых апдейтов
+# (polling и webhook) ждет, поэтому полная очередь заявок тормозит именно прием
+UPDATE_TASKS_LIMIT = int(os.getenv('UPDATE_TASKS_LIMIT', 100))
+
+# Типы апдейтов, которые бот обрабатывает; остальные Telegram не присылает
+ALLOWED_UPDATES = ["message", "callback_query", "chat_join_request"]
 
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+storage = PostgresStorage() if FSM_STORAGE == "postgres" else MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+instrument_bot(bot)
+instrument_router(router)
+track_interactive_traffic(dp)
 
 CHANNEL_ID = -1002788956369
 
 ADMIN_IDS = [7118184736, 889158373]
 
+FIND_PAGE_SIZE = 10
+USERS_PAGE_SIZE = 10
+
 @router.message(Command("start"))
 async def start_command(message: Message):
     user = message.from_user
-    print(f"[LOG] Команда /start от пользователя {user.id} (@{user.username})")
+    logger.debug("Команда /start от @%s", user.username, extra={'user_id': user.id})
     
     await save_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
-        last_name=user.last_name
+        last_name=user.last_name,
+        reactivate=True,
+        source='start'
     )
     
     if user.id in ADMIN_IDS:
         admin_text = f"👋 Привет, {user.first_name}!\n\n🔧 Панель администратора\n\nВыберите действие:"
         admin_keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💬 Рассылка", callback_data="admin:mailing")],
-            [InlineKeyboardButton(text="📊 Статистика", callback_data="admin:stats")]
+            [InlineKeyboardButton(text="📊 Статистика", callback_data="admin:stats")],
+            [InlineKeyboardButton(text="👥 Пользователи", callback_data="admin:users")]
         ])
         await message.answer(admin_text, reply_markup=admin_keyboard)
-        print(f"[LOG] Админ панель показана пользователю {user.id}")
+        logger.info("Админ панель показана", extra={'user_id': user.id})
     else:
-        print(f"[LOG] Пользователь {user.id} (@{user.username}) не является админом - панель не показана")
+        logger.debug("Пользователь @%s не является админом - панель не показана", user.username,
+                     extra={'user_id': user.id})
 
 
 @router.callback_query(F.data.startswith('admin:'))
@@ -73,33 +117,189 @@ async def admin_callback(callback: CallbackQuery):
         )
         
     elif action == "stats":
-        users = await get_all_users()
-        stats_text = f"📊 **СТАТИСТИКА**\n\n👥 Всего пользователей: {len(users)}"
+        stats = await get_user_statistics()
+        queue = join_queue.metrics()
+        stats_text = (
+            f"{format_user_statistics(stats)}\n\n"
+            f"📥 Очередь заявок: {queue['depth']} "
+            f"(обработано {queue['processed']}, повторов {queue['deduplicated']}, "
+            f"ожидание ср. {queue['avg_wait']:.1f}с / макс. {queue['max_wait']:.1f}с)"
+        )
+        open_requests = join_approver.open_requests
+        stats_text += (
+            f"\n✋ Заявки без решения: ждут проверки {open_requests.get('pending', 0)}, "
+            f"к одобрению {open_requests.get('verified', 0) + open_requests.get('processing', 0)}"
+        )
+        pool_stats = get_pool_stats()
+        if pool_stats:
+            stats_text += (
+                f"\n🗄 Пул БД: занято {pool_stats['in_use']}/{pool_stats['max_size']}, "
+                f"ждут {pool_stats['waiting']}, долгих ожиданий {pool_stats['slow_acquires']} "
+                f"(ср. {pool_stats['avg_wait'] * 1000:.1f}мс / макс. {pool_stats['max_wait'] * 1000:.0f}мс)"
+            )
         await callback.message.edit_text(stats_text, parse_mode="Markdown")
         
     elif action == "users":
-        users = await get_all_users()
-        if users:
-            users_text = "👥 **ПОСЛЕДНИЕ ПОЛЬЗОВАТЕЛИ:**\n\n"
-            for i, user in enumerate(users[:10], 1):
-                username = f"@{user['username']}" if user['username'] else "Нет username"
-                name = f"{user['first_name'] or ''} {user['last_name'] or ''}".strip()
-                name = name if name else "Имя не указано"
-                users_text += f"{i}. {name} ({username})\n"
-        else:
-            users_text = "👥 Пользователей пока нет"
-        
-        await callback.message.edit_text(users_text, parse_mode="Markdown")
+        text, reply_markup = await render_users_page(0)
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+
+
+async def render_users_page(page: int, before=None, after=None):
+    """Одна страница пользователей; позиция передается курсором в callback_data"""
+    rows = await get_users_page(USERS_PAGE_SIZE + 1, before=before, after=after)
+    if after:
+        has_newer = len(rows) > USERS_PAGE_SIZE
+        if not has_newer:
+            # Дошли до начала списка: показываем первую страницу целиком и
+            # сбрасываем нумерацию, которая могла разойтись из-за новых пользователей
+            return await render_users_page(0)
+        users = rows[-USERS_PAGE_SIZE:]
+        has_older = True
+    else:
+        has_newer = page > 0
+        users = rows[:USERS_PAGE_SIZE]
+        has_older = len(rows) > USERS_PAGE_SIZE
+    
+    if not users:
+        return "👥 Пользователей пока нет", None
+    
+    # Номер страницы - только подпись: курсоры не зависят от него, а новые
+    # пользователи сдвигают нумерацию, поэтому не уходим ниже первой страницы
+    page = max(page, 0) if has_newer else 0
+    users_text = f"👥 ПОЛЬЗОВАТЕЛИ (стр. {page + 1}):\n\n"
+    for i, user in enumerate(users, page * USERS_PAGE_SIZE + 1):
+        username = f"@{user['username']}" if user['username'] else "Нет username"
+        name = f"{user['first_name'] or ''} {user['last_name'] or ''}".strip()
+        name = name if name else "Имя не указано"
+        users_text += f"{i}. {name} ({username})\n"
+    
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(
+            text="⬅️ Назад", callback_data=f"users:newer:{max(page - 1, 0)}:{encode_user_cursor(users[0])}"
+        ))
+    if has_older:
+        nav.append(InlineKeyboardButton(
+            text="Вперед ➡️", callback_data=f"users:older:{page + 1}:{encode_user_cursor(users[-1])}"
+        ))
+    reply_markup = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return users_text, reply_markup
+
+
+@router.callback_query(F.data.startswith('users:'))
+async def users_page_callback(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    
+    _, direction, page, cursor = callback.data.split(':', 3)
+    cursor = decode_user_cursor(cursor)
+    if direction == "older":
+        text, reply_markup = await render_users_page(int(page), before=cursor)
+    else:
+        text, reply_markup = await render_users_page(int(page), after=cursor)
+    await callback.message.edit_text(text, reply_markup=reply_markup)
+    await callback.answer()
+
+
+async def render_search_page(query: str, page: int):
+    users, has_next = await search_users_page(query, page, FIND_PAGE_SIZE)
+    if not users:
+        return f"🔍 По запросу «{query}» ничего не найдено", None
+    
+    lines = [f"🔍 Результаты по запросу «{query}» (стр. {page + 1}):"]
+    for i, user in enumerate(users, page * FIND_PAGE_SIZE + 1):
+        lines.append(f"\n{i}. {format_user_info(user)}")
+    
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"find:{page - 1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"find:{page + 1}"))
+    reply_markup = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return "\n".join(lines), reply_markup
 
 
+@router.message(Command("find"))
+async def find_command(message: Message, command: CommandObject, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("🔍 Использование: /find <username, имя или ID>")
+        return
+    
+    # Запрос хранится в FSM, в callback_data передается только номер страницы
+    await state.update_data(find_query=query)
+    text, reply_markup = await render_search_page(query, 0)
+    await message.answer(text, reply_markup=reply_markup)
+
+
+@router.callback_query(F.data.startswith('find:'))
+async def find_page_callback(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    
+    query = (await state.get_data()).get('find_query')
+    if not query:
+        await callback.answer("❌ Поиск устарел, повторите /find", show_alert=True)
+        return
+    
+    page = int(callback.data.split(':')[1])
+    text, reply_markup = await render_search_page(query, page)
+    await callback.message.edit_text(text, reply_markup=reply_markup)
+    await callback.answer()
+
+
+@router.message(Command("export"))
+async def export_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    if export_lock.locked():
+        await message.answer("⏳ Выгрузка уже идет, дождитесь файла")
+        return
+    
+    async with export_lock:
+        status = await message.answer("⏳ Выгружаем пользователей...")
+        path = None
+        try:
+            path, rows = await export_users_file()
+            size = os.path.getsize(path)
+            if size > EXPORT_MAX_FILE_SIZE:
+                await status.edit_text(
+                    f"❌ Файл слишком большой для отправки: {size / 1024 / 1024:.1f} МБ "
+                    f"(лимит {EXPORT_MAX_FILE_SIZE / 1024 / 1024:.0f} МБ)"
+                )
+                return
+            filename = f"users_{datetime.now():%Y%m%d_%H%M}.csv.gz"
+            await message.answer_document(
+                FSInputFile(path, filename=filename),
+                caption=f"📤 Пользователей: {rows}"
+            )
+            await status.delete()
+        except Exception as e:
+            logger.exception("Ошибка выгрузки пользователей",
+                             extra={'user_id': message.from_user.id, 'error_class': type(e).__name__})
+            await status.edit_text("❌ Не удалось выгрузить пользователей")
+        finally:
+            if path:
+                os.remove(path)
+
 
 @router.chat_join_request()
 async def on_join_request(event: ChatJoinRequest):
+    logger.debug("Заявка на вступление от @%s", event.from_user.username, extra={'user_id': event.from_user.id})
+    await join_queue.submit(event)
+
+
+async def process_join_request(event: ChatJoinRequest):
     user_id = event.from_user.id
-    username = event.from_user.username
-    print(f"[LOG] Заявка на вступление от {user_id} (@{username})")
     
-    await save_user(user_id, event.from_user.username, event.from_user.first_name, event.from_user.last_name)
+    await save_user(user_id, event.from_user.username, event.from_user.first_name, event.from_user.last_name,
+                    source='join_request')
+    # Дальше заявкой занимается JoinRequestApprover: одобрит после проверки или отклонит по сроку
+    await add_join_request(event.chat.id, user_id, event.date)
     
     markup = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Я человек")]], resize_keyboard=True)
     
@@ -109,17 +309,30 @@ async def on_join_request(event: ChatJoinRequest):
             "Для доступа в канал необходимо подтвердить, что вы человек:",
             reply_markup=markup
         )
-        print(f"[LOG] Отправлена кнопка 'Я человек' пользователю {user_id}")
+        logger.debug("Отправлена кнопка 'Я человек'", extra={'user_id': user_id})
     except Exception as e:
         if "bot was blocked by the user" in str(e):
-            print(f"[WARNING] Пользователь {user_id} заблокировал бота - не удалось отправить сообщение")
+            logger.warning("Пользователь заблокировал бота - не удалось отправить сообщение", extra={'user_id': user_id})
+            await mark_users_undeliverable([(user_id, 'blocked')])
         else:
-            print(f"[ERROR] Ошибка отправки сообщения пользователю {user_id}: {e}")
+            logger.error("Ошибка отправки сообщения: %s", e, extra={'user_id': user_id, 'error_class': type(e).__name__})
+
+
+join_queue = JoinRequestQueue(process_join_request)
+JOIN_QUEUE_DEPTH.set_function(lambda: join_queue.depth)
+JOIN_REQUESTS.set_function(lambda: {
+    (result,): join_queue.metrics()[result] for result in ('enqueued', 'deduplicated', 'processed', 'failed')
+})
+join_approver = JoinRequestApprover(bot)
+JOIN_APPROVALS.set_function(lambda: dict(join_approver.results))
 
 @router.message(F.text == "Я человек")
 async def verify_human_message(message: Message):
     user = message.from_user
-    print(f"[LOG] Пользователь {user.id} (@{user.username}) нажал 'Я человек'")
+    logger.debug("Пользователь @%s нажал 'Я человек'", user.username, extra={'user_id': user.id})
+    
+    if await verify_join_requests(user.id):
+        join_approver.wake()
     
     try:
         await message.answer(
@@ -127,31 +340,48 @@ async def verify_human_message(message: Message):
             parse_mode="HTML",
             disable_web_page_preview=True
         )
-        print(f"[LOG] Отправлено сообщение пользователю {user.id}")
+        logger.debug("Отправлено сообщение", extra={'user_id': user.id})
     except Exception as e:
         if "bot was blocked by the user" in str(e):
-            print(f"[WARNING] Пользователь {user.id} заблокировал бота - не удалось отправить сообщение")
+            logger.warning("Пользователь заблокировал бота - не удалось отправить сообщение", extra={'user_id': user.id})
         else:
-            print(f"[ERROR] Ошибка отправки сообщения пользователю {user.id}: {e}")
-
-async def get_all_user_ids():
-    users = await get_all_users()
-    return [user['user_id'] for user in users]
+            logger.error("Ошибка отправки сообщения: %s", e, extra={'user_id': user.id, 'error_class': type(e).__name__})
 
 async def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 async def main():
-    print("[LOG] Подключение к базе данных...")
+    setup_logging()
+    logger.info("Подключение к базе данных...")
     await init_db()
+    await start_stats_cache()
+    if isinstance(storage, PostgresStorage):
+        storage.start_cleanup()
+    join_queue.start()
+    join_approver.start()
+    metrics_runner = await start_metrics_server(health_check=ping)
     
-    setup_mailing_handlers(router, bot, get_all_user_ids, is_admin)
+    setup_mailing_handlers(router, bot, is_admin)
+    await resume_broadcast_jobs(bot)
+    start_scheduler(bot)
     
-    print("[LOG] Бот запущен и ожидает события...")
+    logger.info("Бот запущен и ожидает события...")
     try:
-        await dp.start_polling(bot, skip_updates=True)
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, ALLOWED_UPDATES, tasks_limit=UPDATE_TASKS_LIMIT)
+        else:
+            await dp.start_polling(bot, skip_updates=True, allowed_updates=ALLOWED_UPDATES,
+                                   tasks_concurrency_limit=UPDATE_TASKS_LIMIT)
     finally:
+        stop_scheduler()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await join_queue.stop()
+        await join_approver.stop()
+        await storage.close()
+        await stop_stats_cache()
         await close_db()
+        shutdown_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,242 @@
+"""Метрики в текстовом формате Prometheus.
+
+Счетчики - обычные словари в памяти процесса: наблюдение стоит одного
+bisect и пары сложений, поэтому инструментирование можно не выключать
+даже на больших рассылках. HTTP-сервер с /metrics поднимается, только
+если задан METRICS_PORT.
+"""
+import bisect
+import logging
+import os
+import time
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+# 0 - эндпоинт выключен
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._function = None
+        _registry.append(self)
+
+    def set_function(self, function):
+        """Значения считаются при каждом чтении: function() возвращает число
+        или словарь {кортеж значений меток: число}"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            return self._values.items()
+        value = self._function()
+        return value.items() if isinstance(value, dict) else [((), value)]
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for label_values, value in self._samples():
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        state = self._values.get(label_values)
+        if state is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма и количество
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for label_values, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}'
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception("Ошибка чтения метрики %s", metric.name)
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds', 'Время работы обработчиков апдейтов', ('handler', 'status')
+)
+BOT_API_SECONDS = Histogram(
+    'bot_api_request_seconds', 'Время запросов к Bot API', ('method',)
+)
+BOT_API_REQUESTS = Counter(
+    'bot_api_requests_total', 'Запросы к Bot API по исходу (ok или класс ошибки)', ('method', 'outcome')
+)
+DB_POOL_ACQUIRE_SECONDS = Histogram(
+    'db_pool_acquire_seconds', 'Ожидание соединения из пула asyncpg',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+DB_POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Соединения пула asyncpg и ожидающие их запросы', ('state',)
+)
+DB_POOL_SLOW_ACQUIRES = Counter(
+    'db_pool_slow_acquires_total', 'Ожидания соединения дольше DB_POOL_SLOW_ACQUIRE'
+)
+BROADCAST_MESSAGES = Counter(
+    'broadcast_messages_total', 'Сообщения рассылок по исходу', ('outcome',)
+)
+BROADCAST_REMAINING = Gauge(
+    'broadcast_remaining', 'Осталось получателей в запущенных заданиях', ('job_id',)
+)
+USER_CACHE_LOOKUPS = Counter(
+    'user_profile_cache_total', 'Проверки кэша профилей перед сохранением пользователя', ('result',)
+)
+USER_CACHE_SIZE = Gauge(
+    'user_profile_cache_size', 'Профилей в кэше'
+)
+JOIN_QUEUE_DEPTH = Gauge(
+    'join_queue_depth', 'Заявок на вступление в очереди'
+)
+JOIN_REQUESTS = Counter(
+    'join_requests_total', 'Заявки на вступление по результату', ('result',)
+)
+
+JOIN_APPROVALS = Counter(
+    'join_approvals_total', 'Обработанные заявки из pending_join_requests', ('action', 'result')
+)
+
+
+class HandlerMetricsMiddleware:
+    """Inner-middleware роутера: время обработчика по имени функции"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name, status)
+
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и исход каждого вызова Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, name)
+            BOT_API_REQUESTS.inc(name, outcome)
+
+
+def instrument_router(router):
+    middleware = HandlerMetricsMiddleware()
+    for observer in (router.message, router.callback_query, router.chat_join_request):
+        observer.middleware(middleware)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(BotAPIMetricsMiddleware())
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+def _health_handler(health_check):
+    async def handle(request: web.Request) -> web.Response:
+        try:
+            latency = await health_check()
+        except Exception as e:
+            return web.Response(status=503, text=f"fail: {type(e).__name__}")
+        return web.Response(text=f"ok {latency:.3f}")
+    return handle
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT, health_check=None):
+    """Поднимает /metrics (и /healthz, если передан health_check - корутина,
+    возвращающая задержку проверки); возвращает AppRunner или None, если METRICS_PORT не задан"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, _handle_metrics)
+    if health_check:
+        app.router.add_get('/healthz', _health_handler(health_check))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на %s:%d%s", host, port, METRICS_PATH)
+    return runner
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity за раз.
+
+    pause() останавливает выдачу токенов для всех ожидающих сразу, это нужно
+    чтобы выполнить требование retry_after от Telegram.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self._fixed_capacity = capacity
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # Lock выстраивает ожидающих в очередь, токены выдаются по порядку
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def set_rate(self, rate: float):
+        """Меняет скорость; накопленные токены пересчитываются по старой"""
+        if rate == self.rate:
+            return
+        self._refill(max(time.monotonic(), self._updated))
+        self.rate = rate
+        self.capacity = self._fixed_capacity or rate
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = max(self._updated, self._paused_until)
+
+    @property
+    def paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+
+class RateMeter:
+    """Скорость событий (в секунду) за последние window секунд"""
+
+    def __init__(self, window: float = 5):
+        self.window = window
+        self._events = deque()
+
+    def _trim(self, now: float):
+        while self._events and now - self._events[0] > self.window:
+            self._events.popleft()
+
+    def record(self):
+        now = time.monotonic()
+        self._events.append(now)
+        self._trim(now)
+
+    def rate(self) -> float:
+        self._trim(time.monotonic())
+        return len(self._events) / self.window
@@ -0,0 +1,61 @@
+"""Отправляет записанные апдейты Telegram на webhook-сервер бота.
+
+    python replay_updates.py updates.jsonl [--url http://127.0.0.1:8080/webhook]
+
+Файл - JSON с одним апдейтом или списком апдейтов, либо JSONL (апдейт на строку).
+Секрет берется из WEBHOOK_SECRET, как и у самого сервера.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+import aiohttp
+from dotenv import load_dotenv
+
+
+def load_updates(path: str):
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if path.endswith('.jsonl'):
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    data = json.loads(content)
+    return data if isinstance(data, list) else [data]
+
+
+async def replay(url: str, secret: str, updates, concurrency: int):
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, json=update) as response:
+                    statuses[response.status] += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(post(update) for update in updates))
+        elapsed = time.monotonic() - started
+
+    print(f"Отправлено апдейтов: {len(updates)} за {elapsed:.2f}с ({len(updates) / elapsed:.0f}/с)")
+    for status, count in sorted(statuses.items()):
+        print(f"  HTTP {status}: {count}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Повтор записанных апдейтов на webhook")
+    parser.add_argument('path')
+    parser.add_argument('--url', default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', 8080)}"
+                                         f"{os.getenv('WEBHOOK_PATH', '/webhook')}")
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET'))
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    asyncio.run(replay(args.url, args.secret, load_updates(args.path), args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
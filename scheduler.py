@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+from aiogram import Bot
+from rate_limiter import RateMeter
+import database
+import mailing_system
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять наступившие запланированные рассылки, секунды
+SCHEDULER_INTERVAL = float(os.getenv('SCHEDULER_INTERVAL', 30))
+# Рассылки уступают лимит интерактивным ответам (заявки, /start), но не ниже этой скорости
+MAILING_MIN_RATE = float(os.getenv('MAILING_MIN_RATE', 5))
+# Окно, за которое считается скорость интерактивных апдейтов, секунды
+INTERACTIVE_WINDOW = float(os.getenv('INTERACTIVE_WINDOW', 5))
+CAPACITY_INTERVAL = 1
+
+# Апдейты от пользователей: почти каждый означает один ответ бота
+interactive_traffic = RateMeter(INTERACTIVE_WINDOW)
+
+_tasks = []
+
+
+class InteractiveTrafficMiddleware:
+    """Outer-middleware: считает входящие апдейты для распределения лимита"""
+
+    async def __call__(self, handler, event, data):
+        interactive_traffic.record()
+        return await handler(event, data)
+
+
+def track_interactive_traffic(dp):
+    middleware = InteractiveTrafficMiddleware()
+    dp.message.outer_middleware(middleware)
+    dp.chat_join_request.outer_middleware(middleware)
+
+
+def broadcast_rate() -> float:
+    """Доля общего лимита для рассылок: то, что не занято интерактивными ответами"""
+    return max(MAILING_MIN_RATE, mailing_system.MAILING_RATE_LIMIT - interactive_traffic.rate())
+
+
+async def _capacity_loop():
+    previous = None
+    while True:
+        rate = broadcast_rate()
+        mailing_system.mailing_limiter.set_rate(rate)
+        if mailing_system.MAILING_EXECUTOR == 'workers':
+            # Процессы рассылки берут токены из общего бакета в БД
+            try:
+                await database.set_send_budget_rate(rate)
+            except Exception as e:
+                logger.warning("Не удалось обновить лимит рассылок в БД: %s", e,
+                               extra={'error_class': type(e).__name__})
+        if previous is not None and abs(rate - previous) >= 1:
+            logger.debug("Лимит рассылок: %.1f сообщ./с", rate)
+        previous = rate
+        await asyncio.sleep(CAPACITY_INTERVAL)
+
+
+async def _due_jobs_loop(bot: Bot):
+    while True:
+        try:
+            for job in await database.claim_due_broadcast_jobs():
+                logger.info("Запуск запланированной рассылки", extra={'job_id': job['id']})
+                await mailing_system.show_job_status(bot, job)
+                mailing_system.start_broadcast_job(bot, job['id'])
+        except Exception as e:
+            logger.exception("Ошибка запуска запланированных рассылок", extra={'error_class': type(e).__name__})
+        await asyncio.sleep(SCHEDULER_INTERVAL)
+
+
+def start_scheduler(bot: Bot):
+    """Запускает проверку запланированных рассылок и подстройку их лимита под нагрузку"""
+    if not _tasks:
+        _tasks.append(asyncio.create_task(_due_jobs_loop(bot)))
+        _tasks.append(asyncio.create_task(_capacity_loop()))
+
+
+def stop_scheduler():
+    for task in _tasks:
+        task.cancel()
+    _tasks.clear()
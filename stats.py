@@ -0,0 +1,160 @@
+from database import get_user_counters, get_signup_histogram, get_db_timezone, listen, USERS_CREATED_CHANNEL
+from typing import Dict, Any
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+STATS_HISTOGRAM_DAYS = int(os.getenv('STATS_HISTOGRAM_DAYS', 14))
+STATS_BAR_WIDTH = 12
+# Страховочное полное пересчитывание кэша, секунды
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', 300))
+# Сколько дней регистраций держать в кэше: нужно минимум 30 для счетчика за месяц
+STATS_CACHE_DAYS = max(STATS_HISTOGRAM_DAYS, 30)
+
+EMPTY_COUNTERS = {
+    'total_users': 0,
+    'today_users': 0,
+    'week_users': 0,
+    'month_users': 0,
+    'reachable_users': 0,
+    'blocked_users': 0,
+    'deactivated_users': 0,
+    'unreachable_users': 0
+}
+
+# Кэш: счетчики из get_user_counters и регистрации по дням (date -> count).
+# Новые пользователи добавляются по NOTIFY от любого процесса, остальное
+# (статусы доставки) обновляется раз в STATS_CACHE_TTL
+_cache = None
+_cache_loaded_at = 0.0
+_refresh_lock = asyncio.Lock()
+_listener_conn = None
+# Часовой пояс БД: дни регистраций считает CURRENT_DATE в нем, а не в поясе бота
+_db_timezone = None
+
+
+def _on_users_created(conn, pid, channel, payload):
+    if _cache is None:
+        return
+    day, count = payload.split(':')
+    count = int(count)
+    day = date.fromisoformat(day)
+    _cache['total_users'] += count
+    # Новые пользователи создаются с delivery_status = 'active'
+    _cache['reachable_users'] += count
+    _cache['by_day'][day] = _cache['by_day'].get(day, 0) + count
+
+
+def _today() -> date:
+    return datetime.now(_db_timezone).date() if _db_timezone else date.today()
+
+
+async def _load_db_timezone():
+    global _db_timezone
+    name = await get_db_timezone()
+    try:
+        _db_timezone = ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning("Неизвестный часовой пояс БД %s, дни считаются по часам бота", name)
+        _db_timezone = None
+
+
+async def refresh_stats_cache():
+    global _cache, _cache_loaded_at
+    await _load_db_timezone()
+    counters = await get_user_counters()
+    histogram = await get_signup_histogram(STATS_CACHE_DAYS)
+    _cache = dict(counters)
+    _cache['by_day'] = {row['day']: row['signups'] for row in histogram}
+    _cache_loaded_at = time.monotonic()
+
+
+async def start_stats_cache():
+    """Заполняет кэш из БД и подписывается на уведомления о новых пользователях"""
+    global _listener_conn
+    if _listener_conn is None or _listener_conn.is_closed():
+        _listener_conn = await listen(USERS_CREATED_CHANNEL, _on_users_created)
+    # Подписка раньше загрузки: регистрация во время загрузки может учесться дважды,
+    # но не потеряется; расхождение исправит следующее обновление по TTL
+    await refresh_stats_cache()
+
+
+async def stop_stats_cache():
+    global _listener_conn
+    if _listener_conn and not _listener_conn.is_closed():
+        await _listener_conn.close()
+    _listener_conn = None
+
+
+async def _ensure_fresh_cache():
+    if _cache is not None and time.monotonic() - _cache_loaded_at < STATS_CACHE_TTL:
+        return
+    async with _refresh_lock:
+        if _cache is not None and time.monotonic() - _cache_loaded_at < STATS_CACHE_TTL:
+            return
+        if _listener_conn is not None:
+            # Переподключаемся, если соединение для LISTEN было потеряно
+            await start_stats_cache()
+        else:
+            await refresh_stats_cache()
+
+
+def _signups_since(by_day: dict, days: int) -> int:
+    first_day = _today() - timedelta(days=days - 1)
+    return sum(count for day, count in by_day.items() if day >= first_day)
+
+
+async def get_user_statistics(histogram_days: int = STATS_HISTOGRAM_DAYS) -> Dict[str, Any]:
+    """Статистика из кэша; к БД обращается только при первом вызове и по TTL"""
+    try:
+        await _ensure_fresh_cache()
+    except Exception:
+        logger.exception("Ошибка получения статистики")
+        if _cache is None:
+            return {**EMPTY_COUNTERS, 'histogram': []}
+    
+    by_day = _cache['by_day']
+    today = _today()
+    stats = {key: value for key, value in _cache.items() if key != 'by_day'}
+    stats['today_users'] = by_day.get(today, 0)
+    stats['week_users'] = _signups_since(by_day, 7)
+    stats['month_users'] = _signups_since(by_day, 30)
+    stats['histogram'] = [
+        (day, by_day.get(day, 0))
+        for day in (today - timedelta(days=offset) for offset in range(histogram_days - 1, -1, -1))
+    ]
+    return stats
+
+
+def format_histogram(histogram) -> str:
+    if not histogram:
+        return ""
+    peak = max(signups for _, signups in histogram) or 1
+    lines = []
+    for day, signups in histogram:
+        bar = "▇" * round(signups / peak * STATS_BAR_WIDTH)
+        lines.append(f"`{day.strftime('%d.%m')}` {bar} {signups}")
+    return "\n".join(lines)
+
+
+def format_user_statistics(stats: Dict[str, Any]) -> str:
+    text = (
+        f"📊 **СТАТИСТИКА**\n\n"
+        f"👥 Всего пользователей: {stats['total_users']}\n"
+        f"🆕 Сегодня: {stats['today_users']}\n"
+        f"📅 За 7 дней: {stats['week_users']}\n"
+        f"🗓 За 30 дней: {stats['month_users']}\n\n"
+        f"✅ Доступны для рассылки: {stats['reachable_users']}\n"
+        f"🚫 Заблокировали бота: {stats['blocked_users']}\n"
+        f"💀 Удаленные аккаунты: {stats['deactivated_users']}\n"
+        f"🔇 Не начинали диалог: {stats['unreachable_users']}"
+    )
+    histogram = format_histogram(stats.get('histogram'))
+    if histogram:
+        text += f"\n\n📈 Регистрации за {len(stats['histogram'])} дн.:\n{histogram}"
+    return text
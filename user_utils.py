@@ -1,73 +1,64 @@
-from database import get_all_users, get_user
-from typing import List, Dict, Any
-from datetime import datetime
+from database import get_users_page, search_users
+from stats import get_user_statistics
+from typing import List, Dict, Any, Tuple
+from datetime import datetime, timedelta
+import logging
 
+logger = logging.getLogger(__name__)
 
-async def get_user_statistics() -> Dict[str, Any]:
-    try:
-        users = await get_all_users()
-        total_users = len(users)
-        
-        today = datetime.now().date()
-        today_users = sum(1 for user in users if user['created_at'].date() == today)
-        
-        week_ago = datetime.now().date() - datetime.timedelta(days=7)
-        week_users = sum(1 for user in users if user['created_at'].date() >= week_ago)
-        
-        return {
-            'total_users': total_users,
-            'today_users': today_users,
-            'week_users': week_users,
-            'users': users
-        }
-    except Exception as e:
-        print(f"[ERROR] Ошибка получения статистики: {e}")
-        return {
-            'total_users': 0,
-            'today_users': 0,
-            'week_users': 0,
-            'users': []
-        }
+
+def _user_to_dict(user) -> Dict[str, Any]:
+    return {
+        'user_id': user['user_id'],
+        'username': user['username'],
+        'first_name': user['first_name'],
+        'last_name': user['last_name'],
+        'created_at': user['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+    }
 
 
 async def get_recent_users(limit: int = 10) -> List[Dict[str, Any]]:
     try:
-        users = await get_all_users()
-        recent_users = users[:limit]
-        
-        return [
-            {
-                'user_id': user['user_id'],
-                'username': user['username'],
-                'first_name': user['first_name'],
-                'last_name': user['last_name'],
-                'created_at': user['created_at'].strftime('%Y-%m-%d %H:%M:%S')
-            }
-            for user in recent_users
-        ]
-    except Exception as e:
-        print(f"[ERROR] Ошибка получения последних пользователей: {e}")
+        recent_users = await get_users_page(limit)
+        return [_user_to_dict(user) for user in recent_users]
+    except Exception:
+        logger.exception("Ошибка получения последних пользователей")
         return []
 
 
 async def search_user_by_username(username: str) -> Dict[str, Any]:
     try:
-        users = await get_all_users()
-        for user in users:
-            if user['username'] and username.lower() in user['username'].lower():
-                return {
-                    'user_id': user['user_id'],
-                    'username': user['username'],
-                    'first_name': user['first_name'],
-                    'last_name': user['last_name'],
-                    'created_at': user['created_at'].strftime('%Y-%m-%d %H:%M:%S')
-                }
-        return None
-    except Exception as e:
-        print(f"[ERROR] Ошибка поиска пользователя: {e}")
+        users = await search_users(username, limit=1)
+        return _user_to_dict(users[0]) if users else None
+    except Exception:
+        logger.exception("Ошибка поиска пользователя")
         return None
 
 
+async def search_users_page(query: str, page: int = 0, page_size: int = 10) -> Tuple[List[Dict[str, Any]], bool]:
+    """Страница результатов поиска и признак наличия следующей страницы"""
+    try:
+        users = await search_users(query, limit=page_size + 1, offset=page * page_size)
+        return [_user_to_dict(user) for user in users[:page_size]], len(users) > page_size
+    except Exception:
+        logger.exception("Ошибка поиска пользователей")
+        return [], False
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_user_cursor(user) -> str:
+    """Курсор (created_at, id) для callback_data: микросекунды от эпохи и id"""
+    micros = (user['created_at'] - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{user['id']}"
+
+
+def decode_user_cursor(cursor: str):
+    micros, user_pk = cursor.split(':')
+    return _EPOCH + timedelta(microseconds=int(micros)), int(user_pk)
+
+
 def format_user_info(user: Dict[str, Any]) -> str:
     if not user:
         return "Пользователь не найден"
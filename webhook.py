@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес бота (https://example.com). Если не задан, вебхук в Telegram
+# не регистрируется - удобно для локальной проверки через replay_updates.py
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука с ограничением числа фоновых задач апдейтов.
+
+    Когда заняты все tasks_limit слотов, ответ на запрос Telegram задерживается
+    до освобождения слота: Telegram держит не больше max_connections запросов,
+    поэтому прием апдейтов замедляется, а не копит задачи в памяти.
+    """
+
+    def __init__(self, *args, tasks_limit: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(tasks_limit) if tasks_limit else None
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if not self._slots:
+            return await super()._handle_request_background(bot, request)
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot, tasks_limit: int = None) -> web.Application:
+    """aiohttp-приложение, принимающее апдейты на WEBHOOK_PATH.
+
+    Запрос подтверждается сразу, обработка апдейта идет в фоновой задаче; одновременно
+    не больше tasks_limit задач. Запросы без правильного X-Telegram-Bot-Api-Secret-Token
+    отклоняются.
+    """
+    app = web.Application()
+    BoundedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET,
+        tasks_limit=tasks_limit
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates, tasks_limit: int = None):
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для режима webhook нужен WEBHOOK_SECRET")
+
+    app = build_webhook_app(dp, bot, tasks_limit)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=True
+        )
+        logger.info("Вебхук зарегистрирован: %s%s", WEBHOOK_URL.rstrip('/'), WEBHOOK_PATH)
+    else:
+        logger.warning("WEBHOOK_URL не задан - вебхук в Telegram не регистрируется")
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("Webhook-сервер слушает %s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()